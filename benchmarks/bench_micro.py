@@ -0,0 +1,202 @@
+"""
+Microbenchmarks of serialization, validation, Mason builders, error
+responses and URL converters, run against generated datasets of several
+sizes. Results are written as JSON so that runs can be compared.
+
+    python benchmarks/bench_micro.py [--sizes 100,1000,10000] [--output FILE]
+    python benchmarks/bench_micro.py --compare OLD.json [--threshold 0.2]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import timeit
+from datetime import datetime, timezone
+from importlib.metadata import version
+from itertools import cycle, islice
+from superkinodb import create_app, db
+from superkinodb.consts import *
+from superkinodb.dataio import generate_documents, write_batch
+from superkinodb.db_models import Movie, Review
+from superkinodb.resources.movie import MovieConverter
+from superkinodb.resources.review import ReviewConverter
+from superkinodb.utils import SuperkinodbBuilder, error_response, url_template, validate_json
+
+ITEMS = 100
+
+MOVIE = {
+    "name": "Benchmark Movie",
+    "release": "2024-05-06",
+    "genre": "horror",
+    "actors": ["actor-{}".format(i) for i in range(10)],
+    "directors": ["director-1"],
+    "writers": ["writer-1", "writer-2"]
+}
+
+REVIEW = {
+    "reviewer": "critic",
+    "score": 7.5,
+    "review_text": "x" * 500
+}
+
+def create_dataset(path, size):
+    """
+    Creates a database with *size* movies, 3 * *size* persons and 10 *
+    *size* reviews with testgen's generator and returns its app.
+    """
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        documents = generate_documents(size, size * 3, size * 10, seed=1)
+        persons = {}
+        while True:
+            batch = list(islice(documents, IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            write_batch(db.engine, batch, persons)
+    return app
+
+def build_cases(app):
+    """
+    Returns a dictionary of benchmark name -> (function, items per call).
+    Must be called in a request context of *app*, the functions are run in
+    the same context.
+    """
+
+    movies = Movie.query.options(*Movie.load_options()).order_by(Movie.name).limit(ITEMS).all()
+    popular = Movie.query.order_by(Movie.review_count.desc()).first()
+    reviews = Review.query.filter_by(movie_name=popular.name).limit(ITEMS).all()
+    movie_converter = MovieConverter(app.url_map)
+    review_converter = ReviewConverter(app.url_map)
+    movie_names = cycle(movie.name for movie in movies)
+    reviewers = cycle(review.reviewer for review in reviews)
+
+    def movie_item():
+        movie = movies[0]
+        body = SuperkinodbBuilder()
+        body.add_control("self", url_template("api.movieitem", "movie")(movie.name))
+        body.add_namespace("superkinodb", LINK_RELATIONS)
+        body.add_control_all_movies()
+        body.add_control_edit_movie(movie)
+        body.add_control_delete_movie(movie)
+        body.add_control_movie_reviews(movie)
+        return body
+
+    def collection_items():
+        movie_url = url_template("api.movieitem", "movie")
+        items = []
+        for movie in movies:
+            item = SuperkinodbBuilder()
+            item.add_control("self", movie_url(movie.name))
+            items.append(item)
+        return items
+
+    return {
+        "movie.serialize": (lambda: [movie.serialize() for movie in movies], len(movies)),
+        "movie.serialize.short": (
+            lambda: [movie.serialize(short_form=True) for movie in movies], len(movies)
+        ),
+        "review.serialize": (lambda: [review.serialize() for review in reviews], len(reviews)),
+        "builder.movie_item": (movie_item, 1),
+        "builder.collection_items": (collection_items, len(movies)),
+        "error_response": (lambda: error_response(404, "Not found", "No such movie"), 1),
+        "validate.movie": (lambda: validate_json(MOVIE, Movie), 1),
+        "validate.review": (lambda: validate_json(REVIEW, Review), 1),
+        "converter.movie.to_python": (lambda: movie_converter.to_python(next(movie_names)), 1),
+        "converter.movie.to_url": (lambda: movie_converter.to_url(movies[0]), 1),
+        "converter.review.to_python": (lambda: review_converter.to_python(next(reviewers)), 1),
+        "converter.review.to_url": (lambda: review_converter.to_url(reviews[0]), 1),
+    }
+
+def run(sizes, repeat):
+    results = []
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            app = create_dataset(path, size)
+            with app.test_request_context("/api/movies/"):
+                for name, (func, items) in build_cases(app).items():
+                    timer = timeit.Timer(func)
+                    number, _ = timer.autorange()
+                    seconds = min(timer.repeat(number=number, repeat=repeat))
+                    result = {
+                        "name": name,
+                        "size": size,
+                        "us_per_item": seconds / number / items * 1e6,
+                        "number": number,
+                    }
+                    results.append(result)
+                    print("{:<28} {:>7} {:>10.2f} us/item".format(name, size, result["us_per_item"]))
+                db.session.remove()
+            with app.app_context():
+                db.engine.dispose()
+        finally:
+            os.unlink(path)
+    return results
+
+def compare(old, new, threshold):
+    """
+    Prints the change of every benchmark in *new* against *old* and returns
+    the number of benchmarks that got slower by more than *threshold*.
+    """
+
+    previous = {(r["name"], r["size"]): r["us_per_item"] for r in old["results"]}
+    regressions = 0
+    for result in new["results"]:
+        key = (result["name"], result["size"])
+        if key not in previous:
+            continue
+        change = result["us_per_item"] / previous[key] - 1
+        flag = ""
+        if change > threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print("{:<28} {:>7} {:>+8.1%}{}".format(key[0], key[1], change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated numbers of movies in the datasets")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats per benchmark")
+    parser.add_argument("--output", help="result file, by default benchmarks/results/micro-<time>.json")
+    parser.add_argument("--compare", metavar="OLD", help="compare against an earlier result file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown reported as a regression, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    results = {
+        "started": started.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "versions": dict(
+            {package: version(package) for package in ("flask", "sqlalchemy", "jsonschema")},
+            sqlite=sqlite3.sqlite_version
+        ),
+        "results": run([int(size) for size in args.sizes.split(",")], args.repeat),
+    }
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "results",
+        "micro-{}.json".format(started.strftime("%Y%m%dT%H%M%S"))
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {}".format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            raise SystemExit("{} benchmarks got slower".format(regressions))
+
+if __name__ == "__main__":
+    main()
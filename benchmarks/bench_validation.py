@@ -0,0 +1,49 @@
+"""
+Microbenchmark of request body validation. Compares validating with a fresh
+schema and jsonschema.validate on every call, as the resources used to do,
+against the compiled validators of the schema registry.
+
+    python benchmarks/bench_validation.py [--number N]
+"""
+
+import argparse
+import timeit
+from jsonschema import validate, Draft7Validator
+from superkinodb.db_models import Movie, Review
+from superkinodb.utils import register_schemas, validate_json
+
+MOVIE = {
+    "name": "Benchmark Movie",
+    "release": "2024-05-06",
+    "genre": "horror",
+    "actors": ["actor-{}".format(i) for i in range(10)],
+    "directors": ["director-1"],
+    "writers": ["writer-1", "writer-2"]
+}
+
+REVIEW = {
+    "reviewer": "critic",
+    "score": 7.5,
+    "review_text": "x" * 500
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="calls per case")
+    args = parser.parse_args()
+
+    register_schemas()
+    cases = {
+        "movie, schema per call": lambda: validate(
+            MOVIE, Movie.get_schema(), format_checker=Draft7Validator.FORMAT_CHECKER
+        ),
+        "movie, compiled": lambda: validate_json(MOVIE, Movie),
+        "review, schema per call": lambda: validate(REVIEW, Review.get_schema()),
+        "review, compiled": lambda: validate_json(REVIEW, Review),
+    }
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=args.number, repeat=5))
+        print("{:<26} {:>9.1f} us/call".format(name, seconds / args.number * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+Concurrent load test of the API. Starts the app in a threaded Werkzeug
+server in its own process, or uses a running server given with --url, and
+drives a mix of reads and writes over all resources with concurrent clients.
+Reports latency percentiles, throughput and errors per endpoint, with
+"database is locked" failures counted separately.
+
+    python benchmarks/load_test.py [--clients 16] [--duration 30] [--write-ratio 0.2]
+    python benchmarks/load_test.py --database instance/dev.db --output load.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+from collections import defaultdict
+from itertools import islice
+from urllib.parse import quote, urlsplit
+
+LOCKED = "database is locked"
+
+def _serve(database, port, threads):
+    from werkzeug.serving import make_server
+    from superkinodb import create_app
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.abspath(database),
+        # Let errors through to the middleware below so that the client
+        # can tell lock timeouts from other failures
+        "PROPAGATE_EXCEPTIONS": True,
+    })
+    wsgi_app = app.wsgi_app
+
+    def report_errors(environ, start_response):
+        try:
+            return wsgi_app(environ, start_response)
+        except Exception as e:
+            traceback.print_exc()
+            start_response("500 INTERNAL SERVER ERROR", [("Content-Type", "text/plain")])
+            return [str(e).encode("utf-8")]
+
+    app.wsgi_app = report_errors
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, app, threaded=threads)
+    server.serve_forever()
+
+def create_dataset(path, movies):
+    from superkinodb import create_app, db
+    from superkinodb.consts import IMPORT_BATCH_SIZE
+    from superkinodb.dataio import generate_documents, write_batch
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+    with app.app_context():
+        db.create_all()
+        documents = generate_documents(movies, movies * 3, movies * 10, seed=1)
+        persons = {}
+        while True:
+            batch = list(islice(documents, IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            write_batch(db.engine, batch, persons)
+        db.engine.dispose()
+
+def copy_database(source, path):
+    """
+    Copies a database with the SQLite backup API, which also copies the
+    changes still in its write-ahead log.
+    """
+
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+class Client:
+    """
+    One simulated API client. Reads random movies and reviews and writes
+    movies and reviews of its own, so that clients don't conflict with
+    each other except for the database lock.
+    """
+
+    def __init__(self, number, host, port, targets, write_ratio, rng):
+        self.number = number
+        self.host = host
+        self.port = port
+        self.targets = targets
+        self.write_ratio = write_ratio
+        self.rng = rng
+        self.created = 0
+        self.own_movies = []
+        self.own_reviews = []
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers["Content-Type"] = "application/json"
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def _name(self, kind):
+        self.created += 1
+        return "load-{}-{}-{}".format(kind, self.number, self.created)
+
+    def _movie_document(self, name):
+        return {
+            "name": name,
+            "release": "2020-01-01",
+            "genre": self.rng.choice(["drama", "comedy", "horror"]),
+            "actors": ["Actor {}".format(self.rng.randint(1, 100)) for i in range(3)],
+            "directors": ["Director {}".format(self.rng.randint(1, 20))],
+        }
+
+    def _review_document(self, reviewer):
+        return {
+            "reviewer": reviewer,
+            "score": round(self.rng.uniform(0, 10), 1),
+            "review_text": "Load test review number {}".format(self.created),
+        }
+
+    def next_operation(self):
+        """
+        Returns the next request as (endpoint, method, path, body, expected
+        status codes).
+        """
+
+        rng = self.rng
+        movie = rng.choice(self.targets["movies"])
+        movie_path = "/api/movies/{}/".format(quote(movie, safe=""))
+
+        if rng.random() >= self.write_ratio:
+            reads = [
+                ("GET /movies/", "/api/movies/"),
+                ("GET /movies/?genre", "/api/movies/?genre=" + rng.choice(["drama", "comedy", "horror"])),
+                ("GET /movies/<movie>/", movie_path),
+                ("GET /movies/<movie>/reviews/", movie_path + "reviews/"),
+                ("GET /actors/", "/api/actors/"),
+                ("GET /directors/", "/api/directors/"),
+                ("GET /writers/", "/api/writers/"),
+                ("GET /search/", "/api/search/?q=" + rng.choice(["silent", "night", "ending", "cast"])),
+            ]
+            if self.targets["reviews"]:
+                review_movie, reviewer = rng.choice(self.targets["reviews"])
+                reads.append((
+                    "GET /movies/<movie>/reviews/<review>/",
+                    "/api/movies/{}/reviews/{}/".format(quote(review_movie, safe=""), quote(reviewer, safe=""))
+                ))
+            endpoint, path = rng.choice(reads)
+            return endpoint, "GET", path, None, (200,)
+
+        writes = ["post_movie", "post_review", "bulk"]
+        if self.own_movies:
+            writes += ["put_movie", "delete_movie"]
+        if self.own_reviews:
+            writes += ["put_review", "delete_review"]
+        write = rng.choice(writes)
+
+        if write == "post_movie":
+            name = self._name("movie")
+            self.own_movies.append(name)
+            return "POST /movies/", "POST", "/api/movies/", self._movie_document(name), (201,)
+        if write == "bulk":
+            documents = [self._movie_document(self._name("bulk")) for i in range(10)]
+            return "POST /movies-bulk/", "POST", "/api/movies-bulk/", documents, (200,)
+        if write == "post_review":
+            reviewer = self._name("reviewer")
+            self.own_reviews.append((movie, reviewer))
+            return (
+                "POST /movies/<movie>/reviews/", "POST", movie_path + "reviews/",
+                self._review_document(reviewer), (201,)
+            )
+        if write in ("put_movie", "delete_movie"):
+            name = rng.choice(self.own_movies)
+            path = "/api/movies/{}/".format(quote(name, safe=""))
+            if write == "delete_movie":
+                self.own_movies.remove(name)
+                return "DELETE /movies/<movie>/", "DELETE", path, None, (204,)
+            return "PUT /movies/<movie>/", "PUT", path, self._movie_document(name), (204,)
+
+        review_movie, reviewer = rng.choice(self.own_reviews)
+        path = "/api/movies/{}/reviews/{}/".format(quote(review_movie, safe=""), quote(reviewer, safe=""))
+        if write == "delete_review":
+            self.own_reviews.remove((review_movie, reviewer))
+            return "DELETE /movies/<movie>/reviews/<review>/", "DELETE", path, None, (204,)
+        return "PUT /movies/<movie>/reviews/<review>/", "PUT", path, self._review_document(reviewer), (204,)
+
+    def run(self, deadline, results):
+        while time.monotonic() < deadline:
+            endpoint, method, path, body, expected = self.next_operation()
+            start = time.perf_counter()
+            try:
+                status, data = self.request(method, path, body)
+            except (OSError, http.client.HTTPException) as e:
+                status, data = None, str(e).encode("utf-8")
+            elapsed = time.perf_counter() - start
+
+            if status in expected:
+                outcome = "ok"
+            elif LOCKED.encode("utf-8") in data:
+                outcome = "locked"
+            else:
+                outcome = "error"
+            results[endpoint].append((elapsed, outcome))
+
+def discover_targets(host, port, rng):
+    """
+    Collects movie names and (movie, reviewer) pairs to read through the API.
+    """
+
+    client = Client(0, host, port, None, 0, rng)
+    status, data = client.request("GET", "/api/movies/?limit=1000")
+    if status != 200:
+        raise SystemExit("GET /api/movies/ returned {}".format(status))
+    movies = [item["data"]["name"] for item in json.loads(data)["movies"]]
+    if not movies:
+        raise SystemExit("The database has no movies, use --movies to generate some")
+
+    reviews = []
+    for movie in rng.sample(movies, min(20, len(movies))):
+        status, data = client.request("GET", "/api/movies/{}/reviews/".format(quote(movie, safe="")))
+        if status == 200:
+            reviews += [(movie, item["data"]["reviewer"]) for item in json.loads(data)["reviews"]]
+    return {"movies": movies, "reviews": reviews}
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def summarize(results, duration):
+    summary = {}
+    for endpoint, samples in sorted(results.items()):
+        latencies = sorted(elapsed for elapsed, outcome in samples)
+        outcomes = [outcome for elapsed, outcome in samples]
+        summary[endpoint] = {
+            "requests": len(samples),
+            "throughput": len(samples) / duration,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "errors": outcomes.count("error"),
+            "locked": outcomes.count("locked"),
+        }
+    return summary
+
+def print_summary(summary):
+    print("{:<42} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7} {:>7}".format(
+        "endpoint", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "locked"
+    ))
+    for endpoint, row in summary.items():
+        print("{:<42} {:>8} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>7} {:>7}".format(
+            endpoint, row["requests"], row["throughput"], row["p50_ms"], row["p95_ms"],
+            row["p99_ms"], row["errors"], row["locked"]
+        ))
+    requests = sum(row["requests"] for row in summary.values())
+    print("total {} requests, {:.1f} req/s, {} errors, {} locked".format(
+        requests,
+        sum(row["throughput"] for row in summary.values()),
+        sum(row["errors"] for row in summary.values()),
+        sum(row["locked"] for row in summary.values()),
+    ))
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_until_up(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit("The server didn't start")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="test a running server instead of starting one")
+    parser.add_argument("--database", help="database file that the started server tests "
+                        "a temporary copy of, by default a temporary one is generated")
+    parser.add_argument("--movies", type=int, default=1000,
+                        help="movies in the generated database")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--write-ratio", type=float, default=0.2,
+                        help="share of requests that write")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the clients")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    temporary = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        fd, temporary = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        database = temporary
+        # The writes of the test never change the given database
+        if args.database is not None:
+            print("Copying {}".format(args.database))
+            copy_database(args.database, database)
+        else:
+            print("Generating {} movies".format(args.movies))
+            create_dataset(database, args.movies)
+        host, port = "127.0.0.1", _free_port()
+        server = multiprocessing.Process(target=_serve, args=(database, port, True), daemon=True)
+        server.start()
+        _wait_until_up(host, port)
+
+    try:
+        rng = random.Random(args.seed)
+        targets = discover_targets(host, port, rng)
+        results = defaultdict(list)
+        deadline = time.monotonic() + args.duration
+        clients = [
+            Client(i + 1, host, port, targets, args.write_ratio, random.Random(rng.random()))
+            for i in range(args.clients)
+        ]
+        # Every client appends to its own lists, which are merged afterwards
+        client_results = [defaultdict(list) for client in clients]
+        threads = [
+            threading.Thread(target=client.run, args=(deadline, result))
+            for client, result in zip(clients, client_results)
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - started
+        for result in client_results:
+            for endpoint, samples in result.items():
+                results[endpoint] += samples
+
+        summary = summarize(results, duration)
+        print_summary(summary)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({
+                    "clients": args.clients,
+                    "duration": duration,
+                    "write_ratio": args.write_ratio,
+                    "endpoints": summary,
+                }, f, indent=2)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        if temporary is not None:
+            for path in (temporary, temporary + "-wal", temporary + "-shm"):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+if __name__ == "__main__":
+    main()
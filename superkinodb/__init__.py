@@ -1,19 +1,43 @@
 import os
-import json
 from flask import Flask, Response, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_caching import Cache
 from superkinodb.consts import *
+from superkinodb.replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 cache = Cache()
 
-def create_app(test_config=None):
+def create_app(test_config=None, async_database=False):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "dev.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SQLALCHEMY_ENGINE_OPTIONS={},
+        SQLITE_POOL_OPTIONS={
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_timeout": 30,
+        },
+        SQLITE_PRAGMAS={
+            "journal_mode": "wal",
+            "synchronous": "normal",
+            "cache_size": -65536,
+            "mmap_size": 268435456,
+            "busy_timeout": 5000,
+            "temp_store": "memory",
+            "foreign_keys": "on",
+        },
+        REPLICA_DATABASES=[],
+        REPLICA_MAX_LAG=5.0,
+        CACHE_TYPE="SimpleCache",
+        CACHE_DEFAULT_TIMEOUT=300,
+        INSTRUMENTATION=False,
+        SLOW_QUERY_THRESHOLD=None,
+        METRICS=False,
+        METRICS_DIR=None,
+        METRICS_FLUSH_INTERVAL=1.0
     )
 
     print(app.instance_path)
@@ -32,21 +56,46 @@ def create_app(test_config=None):
     from . import api
     from superkinodb.resources.movie import MovieConverter
     from superkinodb.resources.review import ReviewConverter
-    from superkinodb.utils import SuperkinodbBuilder
+    from superkinodb import instrumentation, metrics, replicas, sqlite_profile
+    from superkinodb.utils import SuperkinodbBuilder, encode_json, register_schemas
     app.cli.add_command(db_models.init_db_command) 
+    app.cli.add_command(db_models.upgrade_db_command)
     app.cli.add_command(db_models.populate_db)
+    app.cli.add_command(db_models.cleanup_people_command)
+    app.cli.add_command(db_models.create_indexes_command)
+    app.cli.add_command(db_models.rebuild_review_stats_command)
+    app.cli.add_command(db_models.rebuild_search_command)
+    app.cli.add_command(db_models.export_command)
+    app.cli.add_command(db_models.import_command)
+    app.cli.add_command(db_models.replicate_command)
     app.url_map.converters["movie"] = MovieConverter
     app.url_map.converters["review"] = ReviewConverter
     app.register_blueprint(api.api_bp)
+    register_schemas()
 
+    sqlite_profile.add_pool_options(app)
     db.init_app(app)
+    if async_database:
+        from superkinodb.asgi import use_async_engine
+        use_async_engine(app, db)
+    sqlite_profile.init_app(app, db)
+    replicas.init_app(app)
+    cache.init_app(app)
+    instrumentation.init_app(app, db)
+    metrics.init_app(app)
 
     @app.route('/api/', methods=["GET"])
     def entry_point():
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
         body.add_control("superkinodb:movies", url_for("api.moviecollection"))
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        body.add_control("superkinodb:search", url_for("api.searchcollection"))
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+
+    if app.config["METRICS"]:
+        @app.route("/metrics")
+        def metrics_endpoint():
+            return Response(metrics.render_metrics(), 200, mimetype=metrics.CONTENT_TYPE)
 
     @app.route(LINK_RELATIONS)
     def link_relations():
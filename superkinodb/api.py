@@ -1,8 +1,9 @@
-from superkinodb.resources.movie import MovieItem, MovieCollection
+from superkinodb.resources.movie import MovieItem, MovieCollection, MovieBulk
 from superkinodb.resources.actor import ActorCollection
 from superkinodb.resources.director import DirectorCollection
 from superkinodb.resources.writer import WriterCollection
 from superkinodb.resources.review import ReviewItem, ReviewCollection
+from superkinodb.resources.search import SearchCollection
 from flask import Blueprint
 from flask_restful import Api
 
@@ -15,7 +16,8 @@ api.add_resource(ActorCollection, '/actors/')
 api.add_resource(DirectorCollection, '/directors/')
 api.add_resource(WriterCollection, '/writers/')
 api.add_resource(MovieCollection, '/movies/')
+api.add_resource(MovieBulk, '/movies-bulk/')
 api.add_resource(MovieItem, '/movies/<movie:movie>/')
 api.add_resource(ReviewCollection, '/movies/<movie:movie>/reviews/')
 api.add_resource(ReviewItem, '/movies/<movie:movie>/reviews/<review:review>/')
-
+api.add_resource(SearchCollection, '/search/')
@@ -0,0 +1,194 @@
+"""
+Asynchronous serving mode. The same Flask app is served as an ASGI app with
+the database accessed through aiosqlite. Every request runs the app in a
+greenlet of SQLAlchemy's asyncio extension, so while a request waits for
+the database or a slow client the event loop serves the other requests,
+and the responses are exactly the ones of the WSGI app. Request bodies are
+streamed to the app as it reads them.
+
+    uvicorn --factory superkinodb.asgi:create_asgi_app
+
+Needs the aiosqlite and greenlet packages.
+"""
+
+import asyncio
+import io
+import sys
+import threading
+from sqlalchemy.engine import make_url
+from sqlalchemy.util import await_only, greenlet_spawn
+
+ENGINE_KEY = "superkinodb.async_engine"
+
+def create_async_engine(url, **options):
+    """
+    Creates an aiosqlite engine for *url*, a pysqlite URL. Returns the
+    AsyncEngine, its sync_engine can be used by sync code running in
+    greenlet_spawn.
+    """
+
+    from sqlalchemy.ext.asyncio import create_async_engine as _create_async_engine
+
+    url = make_url(url).set(drivername="sqlite+aiosqlite")
+    return _create_async_engine(url, **options)
+
+def use_async_engine(app, db):
+    """
+    Replaces the default engine of the app with an aiosqlite one.
+    """
+
+    with app.app_context():
+        engine = create_async_engine(db.engine.url, **app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        db.engines[None] = engine.sync_engine
+    app.extensions[ENGINE_KEY] = engine
+
+def run_in_greenlet(fn, *args):
+    """
+    Runs the sync function *fn* in an event loop of its own, for using an
+    async engine outside of requests, e.g. at startup. The loop runs in
+    another thread so that this works under a running loop too.
+    """
+
+    result = {}
+
+    def run():
+        try:
+            result["value"] = asyncio.run(greenlet_spawn(fn, *args))
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+class _RequestBody(io.RawIOBase):
+    """
+    Request body read from the ASGI receive channel as the app consumes it,
+    so that the app can parse a large body incrementally. Must be read in
+    the greenlet of the request.
+    """
+
+    def __init__(self, receive):
+        self.receive = receive
+        self.chunk = b""
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk and self.more_body:
+            message = await_only(self.receive())
+            if message["type"] != "http.request":
+                # The client disconnected
+                self.more_body = False
+                break
+            self.chunk = message.get("body", b"")
+            self.more_body = message.get("more_body", False)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + ("; " if name == "COOKIE" else ",") + value
+        environ[key] = value
+    return environ
+
+class AsgiApp:
+    """
+    ASGI application running a Flask app whose database engine is async.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            body = io.BufferedReader(_RequestBody(receive))
+            await greenlet_spawn(self._run_wsgi, _environ(scope, body), send)
+        else:
+            raise ValueError("Unsupported ASGI scope type {}".format(scope["type"]))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.app.extensions[ENGINE_KEY].dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _run_wsgi(self, environ, send):
+        # Runs in a greenlet, await_only hands the awaitables to the event
+        # loop and the database driver does the same
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [
+                (name.encode("latin-1"), value.encode("latin-1")) for name, value in headers
+            ]
+            return write
+
+        def start():
+            if "started" not in response:
+                response["started"] = True
+                await_only(send({
+                    "type": "http.response.start",
+                    "status": response["status"],
+                    "headers": response["headers"],
+                }))
+
+        def write(data):
+            start()
+            await_only(send({"type": "http.response.body", "body": data, "more_body": True}))
+
+        iterable = self.app.wsgi_app(environ, start_response)
+        try:
+            for data in iterable:
+                if data:
+                    write(data)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        start()
+        await_only(send({"type": "http.response.body", "body": b"", "more_body": False}))
+
+def create_asgi_app(test_config=None):
+    from superkinodb import create_app
+
+    return AsgiApp(create_app(test_config, async_database=True))
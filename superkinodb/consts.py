@@ -1,2 +1,17 @@
 LINK_RELATIONS = "/superkinodb/link-relation/"
+MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+BULK_BATCH_SIZE = 500
+BULK_READ_SIZE = 64 * 1024
+BULK_GET_LIMIT = 100
+
+STREAM_FORMATS = ("mason", "ndjson")
+STREAM_BATCH_SIZE = 500
+
+EXPORT_FORMATS = ("jsonl", "csv")
+EXPORT_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 1000
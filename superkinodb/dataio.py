@@ -0,0 +1,563 @@
+import csv
+import gzip
+import json
+import os
+import random
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
+from itertools import islice
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.pool import NullPool
+from superkinodb.consts import *
+from superkinodb.db_models import *
+from superkinodb.utils import bump_cache_groups, bump_table_versions
+
+# Credits of a movie document: key -> (person model, association table)
+CREDITS = {
+    "actors": (Actor, movie_actors),
+    "directors": (Director, movie_directors),
+    "writers": (Writer, movie_writers),
+}
+
+CSV_FIELDS = ("name", "release", "genre", "actors", "directors", "writers", "reviews")
+
+def guess_format(path):
+    """
+    Returns the export format matching the extension of *path*, ignoring a
+    trailing .gz. Defaults to JSON lines.
+    """
+
+    name = path[:-3] if path.endswith(".gz") else path
+    return "csv" if name.endswith(".csv") else "jsonl"
+
+def open_text(path, mode, compress=False):
+    """
+    Opens *path* as UTF-8 text for reading ("r") or writing ("w"), gzip
+    compressed if *compress* is set.
+    """
+
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+@contextmanager
+def read_snapshot(engine):
+    """
+    Context manager giving a connection that sees one consistent state of
+    the database for as long as it's used, without making writers wait.
+
+    In WAL mode this is just a read transaction, readers don't block writers.
+    In the other journal modes a reader would keep writers out for the whole
+    export, so the database is first copied with the online backup API,
+    which only locks for the duration of the copy, and the copy is read.
+    """
+
+    with engine.connect() as connection:
+        # Autocommit so that the driver doesn't manage the transaction and
+        # the BEGIN below really starts one before the first SELECT
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        if journal_mode.lower() == "wal":
+            connection.exec_driver_sql("BEGIN")
+            try:
+                yield connection
+            finally:
+                connection.exec_driver_sql("ROLLBACK")
+            return
+
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            copy = sqlite3.connect(path)
+            try:
+                connection.connection.driver_connection.backup(copy)
+            finally:
+                copy.close()
+            snapshot = create_engine("sqlite:///" + path, poolclass=NullPool)
+            try:
+                with snapshot.connect() as snapshot_connection:
+                    yield snapshot_connection
+            finally:
+                snapshot.dispose()
+        finally:
+            os.unlink(path)
+
+def iter_movie_documents(connection, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields every movie with its credits and reviews in name order. The
+    documents are in the format of the API, i.e. they validate against the
+    Movie schema, with the reviews added as a list of Review documents.
+
+    Movies are read *batch_size* at a time with keyset pagination and the
+    credits and reviews of a batch with one query per table, so memory use
+    doesn't grow with the size of the database.
+    """
+
+    movie = Movie.__table__
+    review = Review.__table__
+    last_name = None
+    while True:
+        stmt = select(movie.c.id, movie.c.name, movie.c.release, movie.c.genre)
+        if last_name is not None:
+            stmt = stmt.where(movie.c.name > last_name)
+        rows = connection.execute(stmt.order_by(movie.c.name).limit(batch_size)).all()
+        if not rows:
+            return
+
+        documents = {}
+        for row in rows:
+            document = {"name": row.name}
+            if row.release is not None:
+                document["release"] = row.release.isoformat()
+            if row.genre is not None:
+                document["genre"] = row.genre
+            for key in CREDITS:
+                document[key] = []
+            document["reviews"] = []
+            documents[row.id] = document
+
+        for key, (PersonObject, secondary) in CREDITS.items():
+            person = PersonObject.__table__
+            credits = connection.execute(
+                select(secondary.c.movie_id, person.c.name)
+                .join(person, person.c.id == secondary.c[PersonObject.__tablename__ + "_id"])
+                .where(secondary.c.movie_id.in_(documents))
+                .order_by(secondary.c.movie_id, person.c.name)
+            )
+            for movie_id, name in credits:
+                documents[movie_id][key].append(name)
+
+        by_name = {document["name"]: document for document in documents.values()}
+        reviews = connection.execute(
+            select(review.c.movie_name, review.c.reviewer, review.c.score, review.c.review_text)
+            .where(review.c.movie_name.in_(by_name))
+            .order_by(review.c.movie_name, review.c.reviewer)
+        )
+        for row in reviews:
+            item = {"reviewer": row.reviewer, "score": row.score}
+            if row.review_text is not None:
+                item["review_text"] = row.review_text
+            by_name[row.movie_name]["reviews"].append(item)
+
+        for row in rows:
+            yield documents[row.id]
+        last_name = rows[-1].name
+
+def export_movies(connection, stream, fmt, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Writes every movie document to the text *stream* as JSON lines or CSV
+    and returns the number of movies written. In CSV the credit and review
+    lists are JSON encoded and missing values are empty.
+    """
+
+    documents = iter_movie_documents(connection, batch_size)
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, CSV_FIELDS)
+        writer.writeheader()
+        for document in documents:
+            row = {field: document.get(field, "") for field in ("name", "release", "genre")}
+            for field in ("actors", "directors", "writers", "reviews"):
+                row[field] = json.dumps(document[field], ensure_ascii=False)
+            writer.writerow(row)
+            count += 1
+    else:
+        for document in documents:
+            stream.write(json.dumps(document, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+_import_validator = None
+
+def _get_import_validator():
+    # Built lazily once per process, the parsing runs in worker processes
+    global _import_validator
+    if _import_validator is None:
+        schema = Movie.get_schema()
+        schema["properties"]["reviews"] = {
+            "type": "array",
+            "items": Review.get_schema()
+        }
+        _import_validator = Draft7Validator(schema, format_checker=Draft7Validator.FORMAT_CHECKER)
+    return _import_validator
+
+def iter_records(stream, fmt):
+    """
+    Yields the raw records of an export file: lines of JSON for JSON lines
+    and dictionaries of strings for CSV. Parsing the JSON is left to
+    parse_records so that it can be done in parallel.
+    """
+
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield line
+
+def parse_records(fmt, records):
+    """
+    Parses and validates a batch of raw records, see iter_records. Returns
+    a list of (document, error) tuples in the order of *records*, where the
+    document is ready to be written by import_batch, or None if the record
+    is invalid.
+    """
+
+    validator = _get_import_validator()
+    results = []
+    for record in records:
+        try:
+            if fmt == "csv":
+                document = {
+                    field: value for field, value in record.items()
+                    if field in ("name", "release", "genre") and value != ""
+                }
+                for field in ("actors", "directors", "writers", "reviews"):
+                    if record.get(field):
+                        document[field] = json.loads(record[field])
+            else:
+                document = json.loads(record)
+        except (ValueError, AttributeError) as e:
+            results.append((None, "Invalid {}: {}".format(fmt, e)))
+            continue
+
+        error = best_match(validator.iter_errors(document))
+        if error is not None:
+            results.append((None, error.message))
+            continue
+
+        reviews = document.get("reviews", [])
+        reviewers = [review["reviewer"] for review in reviews]
+        if len(set(reviewers)) != len(reviewers):
+            results.append((None, "Duplicate reviewer in the reviews of the movie"))
+            continue
+
+        results.append((_import_document(
+            document["name"],
+            # Defaults to today like a movie created through the API
+            date.fromisoformat(document["release"]) if "release" in document else date.today(),
+            document.get("genre"),
+            # Credits without duplicates, in their original order
+            {key: list(dict.fromkeys(document.get(key, []))) for key in CREDITS},
+            reviews
+        ), None))
+    return results
+
+def _import_document(name, release, genre, credits, reviews):
+    # Document in the form import_batch writes, with the review statistics
+    # of the movie computed up front
+    scores = [review["score"] for review in reviews]
+    return {
+        "name": name,
+        "release": release,
+        "genre": genre,
+        "credits": credits,
+        "reviews": reviews,
+        "review_count": len(scores),
+        "score_sum": float(sum(scores)),
+        "score_min": min(scores) if scores else None,
+        "score_max": max(scores) if scores else None,
+    }
+
+def _chunks(items, size=BULK_BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _resolve_person_ids(connection, PersonObject, names, known):
+    # Persons already seen during the import are looked up from *known*,
+    # the rest are inserted unless they exist and then selected in chunks
+    table = PersonObject.__table__
+    missing = [name for name in set(names) if name not in known]
+    if not missing:
+        return
+    stmt = insert(table).on_conflict_do_nothing(index_elements=["name"])
+    connection.execute(stmt, [{"name": name} for name in missing])
+    for chunk in _chunks(missing):
+        known.update(connection.execute(
+            select(table.c.name, table.c.id).where(table.c.name.in_(chunk))
+        ).all())
+
+def import_batch(connection, documents, persons):
+    """
+    Writes a batch of parsed documents with one executemany INSERT per
+    table. Movies that already exist are skipped.
+
+    : param connection: connection with an open transaction
+    : param documents: list of documents from parse_records
+    : param persons: dictionary of person model -> {name: id} of persons
+        already in the database, updated with the new persons
+    : return: tuple (documents written, list of (document, error) of the
+        skipped ones)
+    """
+
+    movie = Movie.__table__
+    names = [document["name"] for document in documents]
+    existing = set()
+    for chunk in _chunks(names):
+        existing.update(connection.execute(
+            select(movie.c.name).where(movie.c.name.in_(chunk))
+        ).scalars())
+
+    new, skipped = [], []
+    for document in documents:
+        if document["name"] in existing:
+            skipped.append((document, "Movie already exists"))
+        else:
+            existing.add(document["name"])
+            new.append(document)
+    if not new:
+        return [], skipped
+
+    now = utcnow()
+    connection.execute(insert(movie), [{
+        "name": document["name"],
+        "release": document["release"],
+        "genre": document["genre"],
+        "version": 1,
+        "updated_at": now,
+        "review_count": document["review_count"],
+        "score_sum": document["score_sum"],
+        "score_min": document["score_min"],
+        "score_max": document["score_max"],
+    } for document in new])
+    movie_ids = {}
+    for chunk in _chunks(document["name"] for document in new):
+        movie_ids.update(connection.execute(
+            select(movie.c.name, movie.c.id).where(movie.c.name.in_(chunk))
+        ).all())
+
+    for key, (PersonObject, secondary) in CREDITS.items():
+        known = persons.setdefault(PersonObject, {})
+        _resolve_person_ids(
+            connection,
+            PersonObject,
+            (name for document in new for name in document["credits"][key]),
+            known
+        )
+        rows = [
+            {"movie_id": movie_ids[document["name"]], PersonObject.__tablename__ + "_id": known[name]}
+            for document in new
+            for name in document["credits"][key]
+        ]
+        if rows:
+            connection.execute(insert(secondary), rows)
+
+    reviews = [
+        {
+            "movie_name": document["name"],
+            "reviewer": review["reviewer"],
+            "score": review["score"],
+            "review_text": review.get("review_text"),
+            "version": 1,
+            "updated_at": now,
+        }
+        for document in new
+        for review in document["reviews"]
+    ]
+    if reviews:
+        connection.execute(insert(Review.__table__), reviews)
+    return new, skipped
+
+def parse_in_parallel(records, fmt, workers, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Parses *records* with parse_records in a pool of *workers* processes,
+    or in this process if *workers* is 1. Yields (records, results) per
+    batch in input order. Only a few batches per worker are in flight at a
+    time, so the input is never read into memory as a whole.
+    """
+
+    def batches():
+        iterator = iter(records)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    if workers <= 1:
+        for batch in batches():
+            yield batch, parse_records(fmt, batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches():
+            pending.append((batch, executor.submit(parse_records, fmt, batch)))
+            if len(pending) >= workers * 2:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+def drop_secondary_indexes(connection):
+    """
+    Drops the non-unique indexes and the search index triggers before a bulk
+    load, so that only the primary keys and unique constraints, which the
+    load relies on, are maintained row by row.
+    """
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique:
+                index.drop(connection, checkfirst=True)
+    for table in SEARCH_INDEX_DDL:
+        for trigger in ("ai", "ad", "au"):
+            connection.exec_driver_sql("DROP TRIGGER IF EXISTS {}_fts_{}".format(table, trigger))
+
+def create_secondary_indexes(connection):
+    """
+    Re-creates what drop_secondary_indexes dropped, each index in a single
+    pass over its table, rebuilds the search index and runs ANALYZE.
+    """
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    for table, statements in SEARCH_INDEX_DDL.items():
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table))
+    connection.exec_driver_sql("ANALYZE")
+
+def write_batch(engine, documents, persons):
+    """
+    Writes a batch of documents with import_batch in its own transaction and
+    bumps the table versions and cache groups the new movies affect.
+    Returns the same as import_batch.
+    """
+
+    with engine.begin() as connection:
+        written, skipped = import_batch(connection, documents, persons)
+        if written:
+            bump_table_versions(connection, ["movie", "review", "actor", "director", "writer"])
+    if written:
+        bump_cache_groups("movies", "actors", "directors", "writers", "search")
+    return written, skipped
+
+GENRES = (
+    "drama", "comedy", "thriller", "action", "horror", "romance",
+    "documentary", "animation", "science fiction", "western"
+)
+
+TITLE_WORDS = (
+    "Silent", "River", "Last", "Night", "Red", "Garden", "Iron", "Summer",
+    "Shadow", "King", "Broken", "Dream", "Winter", "City", "Lost", "Empire",
+    "Golden", "Road", "Dark", "Island", "Blue", "Storm", "Secret", "Heart"
+)
+
+REVIEW_SENTENCES = (
+    "A slow start but the last act makes up for it.",
+    "The cast carries a script that doesn't deserve them.",
+    "Beautifully shot, every frame could be a painting.",
+    "I checked my watch more than once.",
+    "The soundtrack alone is worth the ticket.",
+    "Predictable, yet strangely comforting.",
+    "One of the best performances of the decade.",
+    "The dialogue feels like it was written by a committee.",
+    "Funny, sharp and surprisingly moving.",
+    "Too long by at least half an hour.",
+    "A bold take on a familiar story.",
+    "The ending will divide audiences.",
+)
+
+def _zipf_weights(n, exponent):
+    # Cumulative weights of ranks 1..n, rank k has weight 1 / k ** exponent
+    total = 0.0
+    weights = []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** exponent
+        weights.append(total)
+    return weights
+
+def generate_documents(movies, people, reviews, seed=0):
+    """
+    Yields *movies* generated movie documents for import_batch, crediting
+    up to *people* persons and with *reviews* reviews in total. The data is
+    skewed like a real catalogue:
+
+    - cast sizes follow a Zipf distribution, most movies credit a few
+      actors and some dozens
+    - persons are credited by Zipf popularity, so a few of them appear in
+      a large share of the movies
+    - reviews go to movies by Zipf popularity, a few popular movies get
+      most of them and many get none
+    - reviewers are picked by Zipf activity, so the same reviewers write
+      reviews for many movies
+
+    The same arguments and seed always give the same documents.
+    """
+
+    rng = random.Random(seed)
+    actors = max(1, people * 8 // 10)
+    directors = max(1, people // 10)
+    writers = max(1, people - actors - directors)
+    pools = {
+        # key: (name prefix, pool size, popularity of the persons, number
+        # of credits per movie)
+        "actors": ("Actor", actors, _zipf_weights(actors, 1.0), _zipf_weights(min(40, actors), 1.5)),
+        "directors": ("Director", directors, _zipf_weights(directors, 1.0), _zipf_weights(min(3, directors), 3.0)),
+        "writers": ("Writer", writers, _zipf_weights(writers, 1.0), _zipf_weights(min(5, writers), 2.0)),
+    }
+
+    # Popularity ranks are shuffled so that popular movies are spread over
+    # the name order
+    popularity = list(range(movies))
+    rng.shuffle(popularity)
+    movie_weights = _zipf_weights(movies, 1.1)
+    review_counts = [0] * movies
+    remaining = reviews
+    while remaining > 0:
+        picks = rng.choices(popularity, cum_weights=movie_weights, k=min(remaining, 100000))
+        for movie in picks:
+            review_counts[movie] += 1
+        remaining -= len(picks)
+
+    reviewers = max(1, reviews // 20, max(review_counts, default=0) * 2)
+    reviewer_ids = range(reviewers)
+    reviewer_weights = _zipf_weights(reviewers, 0.8)
+
+    for i in range(movies):
+        credits = {}
+        for key, (prefix, size, person_weights, count_weights) in pools.items():
+            count = rng.choices(range(1, len(count_weights) + 1), cum_weights=count_weights)[0]
+            picks = rng.choices(range(size), cum_weights=person_weights, k=count)
+            credits[key] = ["{} {}".format(prefix, person + 1) for person in dict.fromkeys(picks)]
+
+        chosen = set()
+        rounds = 0
+        while len(chosen) < review_counts[i]:
+            missing = review_counts[i] - len(chosen)
+            # The most active reviewers are soon all taken for a popular
+            # movie, the rest are filled in uniformly
+            if rounds < 3:
+                chosen.update(rng.choices(reviewer_ids, cum_weights=reviewer_weights, k=missing))
+            else:
+                chosen.update(rng.sample(reviewer_ids, missing))
+            rounds += 1
+
+        quality = rng.uniform(3.0, 9.0)
+        movie_reviews = [
+            {
+                "reviewer": "Reviewer {}".format(reviewer + 1),
+                "score": round(min(10.0, max(0.0, rng.gauss(quality, 1.5))), 1),
+                "review_text": " ".join(rng.choices(REVIEW_SENTENCES, k=rng.randint(1, 6)))
+            }
+            for reviewer in sorted(chosen)
+        ]
+
+        yield _import_document(
+            "{} {} {}".format(rng.choice(TITLE_WORDS), rng.choice(TITLE_WORDS), i + 1),
+            date(1950, 1, 1) + timedelta(days=rng.randrange(75 * 365)),
+            rng.choice(GENRES),
+            credits,
+            movie_reviews
+        )
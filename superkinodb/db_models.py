@@ -1,23 +1,44 @@
 import click
-from datetime import date
+from datetime import datetime, timezone
 from flask.cli import with_appcontext
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import DDL, Index, UniqueConstraint, event, inspect, text
+from sqlalchemy.orm import selectinload
 from superkinodb import db
 from superkinodb.consts import *
 
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 movie_actors = db.Table('movie_actors',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id')),
-    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id')))
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
+    db.Column('actor_id', db.Integer, db.ForeignKey('actor.id'), primary_key=True),
+    db.Index('ix_movie_actors_actor_id', 'actor_id', 'movie_id'))
 
 movie_directors = db.Table('movie_directors',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id')),
-    db.Column('director_id', db.Integer, db.ForeignKey('director.id')))
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
+    db.Column('director_id', db.Integer, db.ForeignKey('director.id'), primary_key=True),
+    db.Index('ix_movie_directors_director_id', 'director_id', 'movie_id'))
 
 movie_writers = db.Table('movie_writers',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id')),
-    db.Column('writer_id', db.Integer, db.ForeignKey('writer.id')))
-
-class Director(db.Model):
+    db.Column('movie_id', db.Integer, db.ForeignKey('movie.id'), primary_key=True),
+    db.Column('writer_id', db.Integer, db.ForeignKey('writer.id'), primary_key=True),
+    db.Index('ix_movie_writers_writer_id', 'writer_id', 'movie_id'))
+
+class PersonMixin:
+    """
+    Methods shared by actors, directors and writers.
+    """
+
+    @classmethod
+    def load_options(cls):
+        """
+        Loader options for queries whose results are serialized, so that the
+        movies of all persons are fetched in one extra query instead of one
+        query per person.
+        """
+        return (selectinload(cls.movies).load_only(Movie.name),)
+
+class Director(PersonMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
 
@@ -35,7 +56,7 @@ class Director(db.Model):
         return data
 
 
-class Writer(db.Model):
+class Writer(PersonMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
 
@@ -53,7 +74,7 @@ class Writer(db.Model):
         return data
 
 
-class Actor(db.Model):
+class Actor(PersonMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, unique=True)
 
@@ -75,6 +96,14 @@ class Movie(db.Model):
     name = db.Column(db.String, nullable=False, unique=True)
     release = db.Column(db.Date, nullable=True)
     genre = db.Column(db.String, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    # Review statistics, kept up to date as reviews are written
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Double, nullable=False, default=0.0)
+    score_min = db.Column(db.Double, nullable=True)
+    score_max = db.Column(db.Double, nullable=True)
 
     directors = db.relationship(
         "Director",
@@ -99,6 +128,13 @@ class Movie(db.Model):
         back_populates="movie",
         cascade="all, delete"
     )
+
+    # Collection filters, the name is included so that a filtered page can
+    # be read in cursor order straight from the index
+    __table_args__ = (
+            Index('ix_movie_genre_name', 'genre', 'name'),
+            Index('ix_movie_release', 'release'),
+    )
    
     @staticmethod
     def get_schema():
@@ -143,6 +179,21 @@ class Movie(db.Model):
         }
         return schema
 
+    @staticmethod
+    def load_options(short_form=False):
+        """
+        Loader options for queries whose results are serialized. The credits
+        are needed only for the full form, they are fetched with one extra
+        query per person type regardless of the number of movies.
+        """
+        if short_form:
+            return ()
+        return (
+            selectinload(Movie.actors).load_only(Actor.name),
+            selectinload(Movie.directors).load_only(Director.name),
+            selectinload(Movie.writers).load_only(Writer.name),
+        )
+
     def serialize(self, short_form=False):
         body = {} 
         body["name"] = self.name
@@ -157,6 +208,13 @@ class Movie(db.Model):
         body["directors"] = [director.name for director in self.directors]
         body["writers"] = [writer.name for writer in self.writers]
 
+        body["reviews"] = {
+            "count": self.review_count,
+            "score_mean": self.score_sum / self.review_count if self.review_count else None,
+            "score_min": self.score_min,
+            "score_max": self.score_max
+        }
+
         return body
 
 class Review(db.Model):
@@ -164,14 +222,17 @@ class Review(db.Model):
     reviewer = db.Column(db.String, nullable=False)
     review_text = db.Column(db.String(1000), nullable=True)
     score = db.Column(db.Double, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
 
-    movie_name = db.Column(db.ForeignKey("movie.name", ondelete="CASCADE"),
+    movie_name = db.Column(db.ForeignKey("movie.name", ondelete="CASCADE", onupdate="CASCADE"),
                                 nullable=False
                             )
     movie = db.relationship("Movie", back_populates="reviews")
 
     __table_args__ = (
             UniqueConstraint('movie_name', 'reviewer', name='unique_movie_review'),
+            Index('ix_review_reviewer', 'reviewer'),
     )
 
     @staticmethod
@@ -212,35 +273,406 @@ class Review(db.Model):
 
         return body
 
+class TableVersion(db.Model):
+    """
+    Version stamp of a whole table, bumped on every flush that writes to the
+    table. Used as the validator for conditional GETs of collections.
+    """
+
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+# Full-text search index. The FTS5 tables use the movie and review tables as
+# external content, so only the index is stored, and triggers keep them in
+# sync with every write, including those that bypass the ORM.
+SEARCH_INDEX_DDL = {
+    "movie": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5("
+        "name, genre, content='movie', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_ai AFTER INSERT ON movie BEGIN "
+        "INSERT INTO movie_fts(rowid, name, genre) VALUES (new.id, new.name, new.genre); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_ad AFTER DELETE ON movie BEGIN "
+        "INSERT INTO movie_fts(movie_fts, rowid, name, genre) "
+        "VALUES ('delete', old.id, old.name, old.genre); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS movie_fts_au AFTER UPDATE OF name, genre ON movie BEGIN "
+        "INSERT INTO movie_fts(movie_fts, rowid, name, genre) "
+        "VALUES ('delete', old.id, old.name, old.genre); "
+        "INSERT INTO movie_fts(rowid, name, genre) VALUES (new.id, new.name, new.genre); "
+        "END",
+    ],
+    "review": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS review_fts USING fts5("
+        "review_text, content='review', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS review_fts_ai AFTER INSERT ON review BEGIN "
+        "INSERT INTO review_fts(rowid, review_text) VALUES (new.id, new.review_text); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS review_fts_ad AFTER DELETE ON review BEGIN "
+        "INSERT INTO review_fts(review_fts, rowid, review_text) "
+        "VALUES ('delete', old.id, old.review_text); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS review_fts_au AFTER UPDATE OF review_text ON review BEGIN "
+        "INSERT INTO review_fts(review_fts, rowid, review_text) "
+        "VALUES ('delete', old.id, old.review_text); "
+        "INSERT INTO review_fts(rowid, review_text) VALUES (new.id, new.review_text); "
+        "END",
+    ],
+}
+
+for _table, _statements in SEARCH_INDEX_DDL.items():
+    for _statement in _statements:
+        event.listen(db.metadata.tables[_table], "after_create", DDL(_statement))
+    event.listen(
+        db.metadata.tables[_table],
+        "before_drop",
+        DDL("DROP TABLE IF EXISTS {}_fts".format(_table))
+    )
+
+# Columns added to existing tables since the first version, with the
+# definitions used to add them to an older database. SQLite only accepts a
+# constant default for a NOT NULL column added with ALTER TABLE, {now} is
+# replaced with the time of the upgrade.
+UPGRADE_COLUMNS = {
+    "movie": [
+        ("version", "INTEGER NOT NULL DEFAULT 1"),
+        ("updated_at", "DATETIME NOT NULL DEFAULT '{now}'"),
+        ("review_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("score_sum", "DOUBLE NOT NULL DEFAULT 0.0"),
+        ("score_min", "DOUBLE"),
+        ("score_max", "DOUBLE"),
+    ],
+    "review": [
+        ("version", "INTEGER NOT NULL DEFAULT 1"),
+        ("updated_at", "DATETIME NOT NULL DEFAULT '{now}'"),
+    ],
+}
+
+def _rebuild_table(connection, table):
+    """
+    Recreates *table* from its model keeping its rows, for schema changes
+    that SQLite's ALTER TABLE can't make, e.g. to foreign keys. The indexes
+    and triggers of the table are recreated and its search index rebuilt.
+    """
+    old_name = table.name + "_old"
+    for kind in ("trigger", "index"):
+        names = connection.execute(text(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = :kind AND tbl_name = :table AND sql IS NOT NULL"
+        ), {"kind": kind, "table": table.name}).scalars().all()
+        for name in names:
+            connection.execute(text("DROP {} {}".format(kind.upper(), name)))
+
+    connection.execute(text("ALTER TABLE {} RENAME TO {}".format(table.name, old_name)))
+    table.create(connection)
+    columns = ", ".join(column.name for column in table.columns)
+    connection.execute(text("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(
+        table.name, columns, old_name
+    )))
+    connection.execute(text("DROP TABLE {}".format(old_name)))
+    if table.name in SEARCH_INDEX_DDL:
+        connection.execute(text(
+            "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table.name)
+        ))
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
     db.create_all()
 
-@click.command("testgen")
+@click.command("upgrade-db")
 @with_appcontext
-def populate_db():
-    for i in range(4):
-        movie = Movie(
-            name="test-movie{}".format(i),
-            release=date.today(),
-            genre="Drama"
-        )
-        db.session.add(movie)
+def upgrade_db_command():
+    """
+    Brings the schema of a database created by an older version up to date
+    with the models: creates the missing tables and adds the missing
+    columns and rebuilds tables whose foreign keys have changed. Existing
+    rows are kept, the review statistics of movies are computed when their
+    columns are added. Run create-indexes and rebuild-search afterwards.
+    """
+    from superkinodb.utils import rebuild_review_stats
+
+    now = utcnow().isoformat(" ", "microseconds")
+    stats_added = False
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                table.create(connection)
+                click.echo("Created {}".format(table.name))
+
+        for table, columns in UPGRADE_COLUMNS.items():
+            existing = {column["name"] for column in inspector.get_columns(table)}
+            for name, definition in columns:
+                if name in existing:
+                    continue
+                connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table, name, definition.format(now=now)
+                )))
+                click.echo("Added {}.{}".format(table, name))
+                if name == "review_count":
+                    stats_added = True
+
+        if stats_added:
+            rebuild_review_stats(connection)
+            click.echo("Rebuilt review statistics")
+
+        # Renaming a movie must rename it in its reviews too
+        foreign_keys = inspector.get_foreign_keys("review")
+        if not any(fk["options"].get("onupdate") == "CASCADE" for fk in foreign_keys):
+            _rebuild_table(connection, Review.__table__)
+            click.echo("Rebuilt review")
+
+@click.command("create-indexes")
+@with_appcontext
+def create_indexes_command():
+    """
+    Brings the indexes of an existing database up to date with the models
+    and refreshes the query planner statistics with ANALYZE. Association
+    tables created without a primary key get an equivalent unique index,
+    duplicate rows are removed first.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            pk_columns = [column.name for column in table.primary_key.columns]
+            has_pk = inspector.get_pk_constraint(table.name)["constrained_columns"]
+            unique_name = "uq_{}_pk".format(table.name)
+            if pk_columns and not has_pk and unique_name not in existing:
+                columns = ", ".join(pk_columns)
+                connection.execute(text(
+                    "DELETE FROM {0} WHERE rowid NOT IN "
+                    "(SELECT min(rowid) FROM {0} GROUP BY {1})".format(table.name, columns)
+                ))
+                connection.execute(text(
+                    "CREATE UNIQUE INDEX {} ON {} ({})".format(unique_name, table.name, columns)
+                ))
+                click.echo("Created {}".format(unique_name))
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+                    click.echo("Created {}".format(index.name))
+
+        connection.execute(text("ANALYZE"))
+    click.echo("Analyzed database")
+
+@click.command("cleanup-people")
+@with_appcontext
+def cleanup_people_command():
+    """
+    Deletes all actors, directors and writers that are not credited in any
+    movie. Orphans are normally removed as movies are edited, this full
+    sweep is only needed for data written outside the API.
+    """
+    from superkinodb.utils import delete_orphans
+
+    for PersonObject in (Actor, Director, Writer):
+        deleted = delete_orphans(PersonObject)
+        click.echo("Deleted {} orphaned {}s".format(len(deleted), PersonObject.__tablename__))
+    db.session.commit()
 
-        actor = Actor(
-            name="actor{}".format(i)
-        )
-        db.session.add(actor)
+@click.command("rebuild-review-stats")
+@with_appcontext
+def rebuild_review_stats_command():
+    """
+    Recomputes the review statistics of every movie from its reviews.
+    """
+    from superkinodb.utils import rebuild_review_stats
 
-        director = Director(
-            name="director{}".format(i)
-        )
-        db.session.add(director)
+    rebuild_review_stats(db.session.connection())
+    db.session.commit()
+    click.echo("Rebuilt review statistics of {} movies".format(Movie.query.count()))
 
-        writer = Writer(
-            name="writer{}".format(i)
-        )
-        db.session.add(writer)
+@click.command("rebuild-search")
+@with_appcontext
+def rebuild_search_command():
+    """
+    Creates the full-text search index on an existing database if it's
+    missing and rebuilds its contents from the movie and review tables.
+    """
+    with db.engine.begin() as connection:
+        for table, statements in SEARCH_INDEX_DDL.items():
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(text(
+                "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table)
+            ))
+            click.echo("Rebuilt {}_fts".format(table))
+
+@click.command("export")
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", "fmt", type=click.Choice(EXPORT_FORMATS),
+              help="Output format, by default taken from the file name.")
+@click.option("--gzip", "compress", is_flag=True,
+              help="Compress the output, implied by a .gz file name.")
+@click.option("--batch-size", default=EXPORT_BATCH_SIZE, show_default=True,
+              help="Movies read per query.")
+@with_appcontext
+def export_command(output, fmt, compress, batch_size):
+    """
+    Exports every movie with its credits and reviews to the file OUTPUT as
+    JSON lines or CSV. The export reads one consistent snapshot
+    of the database and doesn't block writers while it runs.
+    """
+    from superkinodb.dataio import export_movies, guess_format, open_text, read_snapshot
+
+    fmt = fmt or guess_format(output)
+    compress = compress or output.endswith(".gz")
+    with read_snapshot(db.engine) as connection, open_text(output, "w", compress) as stream:
+        count = export_movies(connection, stream, fmt, batch_size)
+    click.echo("Exported {} movies".format(count))
+
+@click.command("replicate")
+@click.option("--interval", type=float, default=None,
+              help="Keep copying every INTERVAL seconds instead of once.")
+@with_appcontext
+def replicate_command(interval):
+    """
+    Copies the database into the read replicas in REPLICA_DATABASES with
+    the SQLite backup API. Requests only read from replicas copied within
+    REPLICA_MAX_LAG seconds, so the interval must be shorter than that.
+    """
+    import sqlite3
+    import time
+    from flask import current_app
+    from superkinodb.replicas import replica_paths, sync_replica
+
+    paths = replica_paths(current_app)
+    if not paths:
+        raise click.ClickException("REPLICA_DATABASES is not set")
+
+    while True:
+        for path in paths:
+            started = time.monotonic()
+            try:
+                sync_replica(db.engine, path)
+            except sqlite3.Error as e:
+                if interval is None:
+                    raise click.ClickException("Copying {} failed: {}".format(path, e))
+                click.echo("Copying {} failed: {}".format(path, e), err=True)
+                continue
+            click.echo("Copied {} in {:.2f} s".format(path, time.monotonic() - started))
+        if interval is None:
+            break
+        time.sleep(interval)
+
+@click.command("import")
+@click.argument("input_path", metavar="INPUT", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(EXPORT_FORMATS),
+              help="Input format, by default taken from the file name.")
+@click.option("--gzip", "compress", is_flag=True,
+              help="Decompress the input, implied by a .gz file name.")
+@click.option("--workers", type=int, default=None,
+              help="Parser processes, by default one per CPU.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True,
+              help="Movies written per transaction.")
+@click.option("--drop-indexes", is_flag=True,
+              help="Drop the secondary and search indexes during the load and re-create them after it.")
+@with_appcontext
+def import_command(input_path, fmt, compress, workers, batch_size, drop_indexes):
+    """
+    Imports movies with their credits and reviews from a file written by
+    export. Records are parsed and validated in parallel worker processes
+    and written with one INSERT per table and batch. Movies that already
+    exist are skipped.
+    """
+    import os
+    import time
+    from superkinodb.dataio import (
+        create_secondary_indexes, drop_secondary_indexes, guess_format, iter_records,
+        open_text, parse_in_parallel, write_batch
+    )
 
-    db.session.commit()
+    fmt = fmt or guess_format(input_path)
+    compress = compress or input_path.endswith(".gz")
+    workers = workers or os.cpu_count() or 1
+
+    if drop_indexes:
+        with db.engine.begin() as connection:
+            drop_secondary_indexes(connection)
+
+    persons = {}
+    read = movies = reviews = failed = 0
+    start = reported = time.monotonic()
+    try:
+        with open_text(input_path, "r", compress) as stream:
+            batches = parse_in_parallel(iter_records(stream, fmt), fmt, workers, batch_size)
+            for records, results in batches:
+                documents = []
+                for number, (document, error) in enumerate(results, start=read + 1):
+                    if error is None:
+                        documents.append(document)
+                    else:
+                        failed += 1
+                        click.echo("Record {}: {}".format(number, error), err=True)
+                read += len(records)
+
+                written, skipped = write_batch(db.engine, documents, persons)
+                for document, error in skipped:
+                    failed += 1
+                    click.echo("{}: {}".format(document["name"], error), err=True)
+                movies += len(written)
+                reviews += sum(document["review_count"] for document in written)
+
+                now = time.monotonic()
+                if now - reported >= 1:
+                    reported = now
+                    click.echo("{} movies, {} reviews, {:.0f} records/s".format(
+                        movies, reviews, read / (now - start)
+                    ))
+    finally:
+        if drop_indexes:
+            click.echo("Re-creating indexes")
+            with db.engine.begin() as connection:
+                create_secondary_indexes(connection)
+
+    elapsed = time.monotonic() - start
+    click.echo("Imported {} movies and {} reviews in {:.1f} s ({:.0f} reviews/s), {} failed".format(
+        movies, reviews, elapsed, reviews / elapsed if elapsed else 0, failed
+    ))
+
+@click.command("testgen")
+@click.option("--movies", default=100, show_default=True, help="Number of movies.")
+@click.option("--people", default=300, show_default=True,
+              help="Number of actors, directors and writers to credit.")
+@click.option("--reviews", default=1000, show_default=True, help="Number of reviews.")
+@click.option("--seed", default=0, show_default=True,
+              help="Random seed, the same seed gives the same data.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True,
+              help="Movies written per transaction.")
+@with_appcontext
+def populate_db(movies, people, reviews, seed, batch_size):
+    """
+    Fills the database with generated movies, persons and reviews. The
+    data is skewed like a real catalogue, see generate_documents, and is
+    written with the bulk inserts of the import command, so millions of
+    rows can be generated for performance testing.
+    """
+    import time
+    from itertools import islice
+    from superkinodb.dataio import generate_documents, write_batch
+
+    start = time.monotonic()
+    documents = generate_documents(movies, people, reviews, seed)
+    persons = {}
+    written = skipped = review_count = 0
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        new, existing = write_batch(db.engine, batch, persons)
+        written += len(new)
+        skipped += len(existing)
+        review_count += sum(document["review_count"] for document in new)
+
+    click.echo("Generated {} movies and {} reviews in {:.1f} s".format(
+        written, review_count, time.monotonic() - start
+    ))
+    if skipped:
+        click.echo("Skipped {} movies that already exist".format(skipped))
@@ -0,0 +1,155 @@
+"""
+Opt-in request instrumentation. With INSTRUMENTATION set, every request
+counts its queries and measures the time spent in SQL, schema validation and
+JSON encoding. The results are sent in a Server-Timing header and logged as
+one JSON line per request. With SLOW_QUERY_THRESHOLD (seconds) set, queries
+that take longer are logged with the endpoint that ran them. The same
+numbers are collected for the metrics when METRICS is set.
+"""
+
+import json
+import logging
+import sqlite3
+from contextlib import contextmanager
+from time import perf_counter
+from flask import has_request_context, request
+from sqlalchemy import event
+from superkinodb.replicas import EXTENSION_KEY as REPLICAS_KEY
+
+STATS_KEY = "superkinodb.stats"
+
+request_logger = logging.getLogger("superkinodb.requests")
+slow_query_logger = logging.getLogger("superkinodb.slow_queries")
+
+class RequestStats:
+    """
+    Time spent by one request, kept in the WSGI environ of the request.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.lock_failures = 0
+        self.writes = []
+        self.timings = {"sql": 0.0, "validation": 0.0, "json": 0.0}
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+def current_stats():
+    """
+    Returns the RequestStats of the current request, or None if there is no
+    request or it isn't instrumented.
+    """
+
+    if not has_request_context():
+        return None
+    return request.environ.get(STATS_KEY)
+
+@contextmanager
+def timed(category):
+    """
+    Adds the time spent in the block to *category* of the current request.
+    Does nothing when the request isn't instrumented.
+    """
+
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats.timings[category] += perf_counter() - start
+
+def server_timing(stats, total):
+    metrics = [
+        "{};dur={:.2f}".format(name, seconds * 1000)
+        for name, seconds in stats.timings.items()
+    ]
+    metrics[0] += ';desc="{} queries"'.format(stats.queries)
+    metrics.append("total;dur={:.2f}".format(total * 1000))
+    return ", ".join(metrics)
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+def _listen_queries(engine, collect, threshold):
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["query_start"].pop()
+        if collect:
+            stats = current_stats()
+            if stats is not None:
+                stats.queries += 1
+                stats.timings["sql"] += elapsed
+                # The first write of a transaction waits up to busy_timeout
+                # for other writers to release the database
+                if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+                    stats.writes.append(elapsed)
+        if threshold is not None and elapsed >= threshold:
+            slow_query_logger.warning(json.dumps({
+                "duration_ms": round(elapsed * 1000, 3),
+                "endpoint": request.endpoint if has_request_context() else None,
+                "statement": statement,
+            }))
+
+    @event.listens_for(engine, "handle_error")
+    def discard_query(context):
+        # The after event isn't sent for failed statements
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+        error = context.original_exception
+        if collect and isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+            stats = current_stats()
+            if stats is not None:
+                stats.lock_failures += 1
+
+def init_app(app, db):
+    instrument = app.config["INSTRUMENTATION"]
+    threshold = app.config["SLOW_QUERY_THRESHOLD"]
+    collect = instrument or app.config["METRICS"]
+    if collect or threshold is not None:
+        with app.app_context():
+            engines = [db.engine]
+        engines += [replica.engine for replica in app.extensions.get(REPLICAS_KEY, [])]
+        for engine in engines:
+            _listen_queries(engine, collect, threshold)
+    if not collect:
+        return
+
+    wsgi_app = app.wsgi_app
+
+    def instrumented(environ, start_response):
+        # Created here and not in before_request, so that the queries of
+        # the URL converters are counted too
+        environ[STATS_KEY] = RequestStats()
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = instrumented
+    if not instrument:
+        return
+
+    @app.after_request
+    def report_timings(response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        total = stats.elapsed()
+        response.headers["Server-Timing"] = server_timing(stats, total)
+        request_logger.info(json.dumps(dict(
+            {
+                "method": request.method,
+                "path": request.full_path.rstrip("?"),
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "queries": stats.queries,
+                "total_ms": round(total * 1000, 3),
+            },
+            **{name + "_ms": round(seconds * 1000, 3) for name, seconds in stats.timings.items()}
+        )))
+        return response
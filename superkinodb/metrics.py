@@ -0,0 +1,259 @@
+"""
+Runtime metrics in the Prometheus text format, served from /metrics when
+METRICS is set. Every process counts into its own registry. With
+METRICS_DIR set, the processes write their registries into that directory
+at most every METRICS_FLUSH_INTERVAL seconds and /metrics sums up the files
+of all processes, so that any worker can serve the metrics of all of them.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from time import monotonic
+from flask import current_app, request
+from superkinodb.instrumentation import current_stats
+
+EXTENSION_KEY = "superkinodb.metrics"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "superkinodb_requests_total": (
+        "counter", "Requests by route, method and status code.", None
+    ),
+    "superkinodb_request_duration_seconds": (
+        "histogram", "Request duration by route and method.", DURATION_BUCKETS
+    ),
+    "superkinodb_response_size_bytes": (
+        "histogram", "Response body size by route and method, streamed responses excluded.", SIZE_BUCKETS
+    ),
+    "superkinodb_db_queries_total": (
+        "counter", "Database queries run by requests, by route.", None
+    ),
+    "superkinodb_db_query_seconds_total": (
+        "counter", "Time spent in database queries by requests, by route.", None
+    ),
+    "superkinodb_db_write_seconds": (
+        "histogram", "Duration of write statements by requests, including waits for the SQLite write lock, by route.", DURATION_BUCKETS
+    ),
+    "superkinodb_sqlite_lock_failures_total": (
+        "counter", "Queries that failed because the SQLite database stayed locked past the busy timeout, by route.", None
+    ),
+    "superkinodb_cache_requests_total": (
+        "counter", "Response cache lookups by result (hit or miss).", None
+    ),
+}
+
+class Registry:
+    """
+    Counters and histograms of one process. Values are keyed by metric name
+    and a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        """
+        Returns the values as a JSON serializable dictionary.
+        """
+
+        with self.lock:
+            return {
+                "counters": [
+                    [name, list(labels), value] for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, list(labels), list(counts), total, count]
+                    for (name, labels), (counts, total, count) in self.histograms.items()
+                ],
+            }
+
+def merge(snapshots):
+    """
+    Sums up registry snapshots into (counters, histograms) dictionaries
+    keyed like the ones of Registry.
+    """
+
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total, count in snapshot["histograms"]:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if key not in histograms:
+                histograms[key] = [list(counts), total, count]
+                continue
+            merged = histograms[key]
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+    return counters, histograms
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+def render(counters, histograms):
+    """
+    Renders merged values in the Prometheus text exposition format.
+    """
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), _format_number(value)))
+            continue
+        for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(buckets + (float("inf"),), counts + [count - sum(counts)]):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(
+                    name, _format_labels(labels + (("le", _format_number(float(bound))),)), cumulative
+                ))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_number(total)))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels), count))
+    return "\n".join(lines) + "\n"
+
+class Metrics:
+    """
+    The registry of an app and its file-backed sharing between processes.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.registry = Registry()
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flushed = monotonic()
+
+    def _path(self):
+        return os.path.join(self.directory, "metrics-{}.json".format(os.getpid()))
+
+    def flush(self, force=False):
+        """
+        Writes the registry of this process into the metrics directory if
+        the flush interval has passed since the last write.
+        """
+
+        if self.directory is None:
+            return
+        now = monotonic()
+        if not force and now - self.flushed < self.flush_interval:
+            return
+        self.flushed = now
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".metrics-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(temp_path, self._path())
+
+    def collect(self):
+        """
+        Returns the merged values of all processes sharing the metrics
+        directory, or of this process only without one.
+        """
+
+        if self.directory is None:
+            return merge([self.registry.snapshot()])
+
+        self.flush(force=True)
+        snapshots = []
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith("metrics-") and filename.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or replaced while reading
+                continue
+        return merge(snapshots)
+
+def get_metrics():
+    """
+    Returns the Metrics of the current app, or None if metrics are off.
+    """
+
+    return current_app.extensions.get(EXTENSION_KEY)
+
+def count_cache_lookup(hit):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.registry.inc("superkinodb_cache_requests_total", {"result": "hit" if hit else "miss"})
+
+def render_metrics():
+    return render(*get_metrics().collect())
+
+def init_app(app):
+    if not app.config["METRICS"]:
+        return
+
+    directory = app.config["METRICS_DIR"]
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    metrics = Metrics(directory, app.config["METRICS_FLUSH_INTERVAL"])
+    app.extensions[EXTENSION_KEY] = metrics
+    registry = metrics.registry
+
+    @app.after_request
+    def count_request(response):
+        stats = current_stats()
+        if stats is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        labels = {"route": route, "method": request.method}
+        registry.inc("superkinodb_requests_total", dict(labels, status=str(response.status_code)))
+        registry.observe("superkinodb_request_duration_seconds", labels, stats.elapsed())
+        if not response.is_streamed:
+            registry.observe("superkinodb_response_size_bytes", labels, len(response.get_data()))
+        if stats.queries:
+            registry.inc("superkinodb_db_queries_total", {"route": route}, stats.queries)
+            registry.inc("superkinodb_db_query_seconds_total", {"route": route}, stats.timings["sql"])
+        for elapsed in stats.writes:
+            registry.observe("superkinodb_db_write_seconds", {"route": route}, elapsed)
+        if stats.lock_failures:
+            registry.inc("superkinodb_sqlite_lock_failures_total", {"route": route}, stats.lock_failures)
+        metrics.flush()
+        return response
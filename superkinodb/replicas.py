@@ -0,0 +1,160 @@
+"""
+Read replicas of the SQLite database. The files in REPLICA_DATABASES are
+copies of the database refreshed with the SQLite backup API by the replicate
+command. GET requests read from a replica that was refreshed at most
+REPLICA_MAX_LAG seconds ago and everything else uses the database itself.
+A client that has written gets a cookie that keeps its reads on the primary
+until a replica has caught up with its write.
+"""
+
+import os
+import random
+import sqlite3
+import time
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from superkinodb.asgi import ENGINE_KEY as ASYNC_ENGINE_KEY, create_async_engine
+from superkinodb.sqlite_profile import apply_pragmas
+
+EXTENSION_KEY = "superkinodb.replicas"
+
+WRITE_COOKIE = "superkinodb_write"
+
+READ_METHODS = ("GET", "HEAD")
+
+class Replica:
+
+    def __init__(self, path, engine):
+        self.path = path
+        self.engine = engine
+
+    @property
+    def stamp_path(self):
+        return self.path + ".synced"
+
+    def synced_at(self):
+        """
+        Returns the time of the snapshot of the database the replica holds,
+        or None if it hasn't been copied yet.
+        """
+
+        try:
+            return os.stat(self.stamp_path).st_mtime
+        except OSError:
+            return None
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read requests to a replica.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing:
+            replica = read_replica()
+            if replica is not None:
+                return replica[0].engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def _written_at():
+    try:
+        return float(request.cookies.get(WRITE_COOKIE, 0))
+    except ValueError:
+        return 0
+
+def read_replica():
+    """
+    Returns (replica, time it was synced at) for the current request, or
+    None if the request must use the primary database. The choice is made
+    once per request so that all of its queries see the same data.
+    """
+
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+    replicas = current_app.extensions.get(EXTENSION_KEY)
+    if not replicas:
+        return None
+
+    if "read_replica" not in g:
+        oldest = max(time.time() - current_app.config["REPLICA_MAX_LAG"], _written_at())
+        fresh = []
+        for replica in replicas:
+            synced_at = replica.synced_at()
+            if synced_at is not None and synced_at >= oldest:
+                fresh.append((replica, synced_at))
+        g.read_replica = random.choice(fresh) if fresh else None
+    return g.read_replica
+
+def read_source():
+    """
+    Returns a string identifying the data the current request reads, for
+    keeping the cached responses of replicas apart from the primary's.
+    """
+
+    replica = read_replica()
+    if replica is None:
+        return "primary"
+    return "{}@{}".format(os.path.basename(replica[0].path), replica[1])
+
+def sync_replica(engine, path):
+    """
+    Copies the database of *engine* into the replica file at *path* and
+    stamps the replica with the time the copy was started. Replicas are kept
+    in WAL mode so that the copy doesn't block the requests reading them.
+    """
+
+    started = time.time()
+    source = engine.raw_connection()
+    try:
+        target = sqlite3.connect(path, timeout=30)
+        try:
+            target.execute("PRAGMA journal_mode=wal")
+            source.driver_connection.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    stamp_path = path + ".synced"
+    with open(stamp_path, "a"):
+        pass
+    os.utime(stamp_path, (started, started))
+
+def replica_paths(app):
+    return [
+        os.path.join(app.instance_path, path) for path in app.config["REPLICA_DATABASES"]
+    ]
+
+def init_app(app):
+    paths = replica_paths(app)
+    if not paths:
+        return
+
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    replicas = []
+    for path in paths:
+        if app.extensions.get(ASYNC_ENGINE_KEY) is not None:
+            engine = create_async_engine("sqlite:///" + path, **options).sync_engine
+        else:
+            engine = create_engine("sqlite:///" + path, **options)
+
+        # The replicate command is the only writer of a replica
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            apply_pragmas(dbapi_connection, dict(pragmas, query_only="on"))
+
+        replicas.append(Replica(path, engine))
+    app.extensions[EXTENSION_KEY] = replicas
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            response.set_cookie(
+                WRITE_COOKIE,
+                repr(time.time()),
+                max_age=int(app.config["REPLICA_MAX_LAG"]) + 1,
+                httponly=True,
+                samesite="Lax"
+            )
+        return response
@@ -1,13 +1,27 @@
-import json
 from flask import Response, url_for
 from flask_restful import Resource
 from superkinodb.db_models import Actor
 from superkinodb.consts import *
-from superkinodb.utils import SuperkinodbBuilder, error_response
+from superkinodb.utils import SuperkinodbBuilder, error_response, paginate, add_total_count, cached_response, conditional_response, table_stamp, stream_format, stream_collection, encode_json
 
 class ActorCollection(Resource):
+    @conditional_response(lambda: table_stamp("actor", "movie"))
+    @cached_response("actors")
     def get(self):
-        actors = Actor.query.order_by(Actor.name)
+        query = Actor.query
+        try:
+            stream = stream_format()
+            if not stream:
+                actors, prev_key, next_key = paginate(
+                    query.options(*Actor.load_options()),
+                    Actor.name
+                )
+        except ValueError as e:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                str(e)
+            )
 
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
@@ -16,12 +30,24 @@ class ActorCollection(Resource):
         body.add_control_all_directors()
         body.add_control_all_writers()
 
+        if stream:
+            resp = stream_collection(
+                body,
+                "actors",
+                query.options(*Actor.load_options()).order_by(Actor.name),
+                Actor.serialize,
+                stream
+            )
+            return add_total_count(resp, query, Actor.name)
+
+        body.add_control_pagination("api.actorcollection", prev_key, next_key)
         body["actors"] = []
 
         for actor in actors:
             body["actors"].append(actor.serialize())
 
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        resp = Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+        return add_total_count(resp, query, Actor.name)
 
     def post(self):
         resp = error_response(
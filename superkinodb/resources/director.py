@@ -1,13 +1,27 @@
-import json
 from flask import Response, url_for
 from flask_restful import Resource
 from superkinodb.db_models import Director
 from superkinodb.consts import *
-from superkinodb.utils import SuperkinodbBuilder, error_response 
+from superkinodb.utils import SuperkinodbBuilder, error_response, paginate, add_total_count, cached_response, conditional_response, table_stamp, stream_format, stream_collection, encode_json
 
 class DirectorCollection(Resource):
+    @conditional_response(lambda: table_stamp("director", "movie"))
+    @cached_response("directors")
     def get(self):
-        directors = Director.query.order_by(Director.name)
+        query = Director.query
+        try:
+            stream = stream_format()
+            if not stream:
+                directors, prev_key, next_key = paginate(
+                    query.options(*Director.load_options()),
+                    Director.name
+                )
+        except ValueError as e:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                str(e)
+            )
 
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
@@ -16,12 +30,24 @@ class DirectorCollection(Resource):
         body.add_control_all_actors()
         body.add_control_all_writers()
 
+        if stream:
+            resp = stream_collection(
+                body,
+                "directors",
+                query.options(*Director.load_options()).order_by(Director.name),
+                Director.serialize,
+                stream
+            )
+            return add_total_count(resp, query, Director.name)
+
+        body.add_control_pagination("api.directorcollection", prev_key, next_key)
         body["directors"] = []
 
         for director in directors: 
             body["directors"].append(director.serialize())
         
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        resp = Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+        return add_total_count(resp, query, Director.name)
 
     def post(self):
         resp = error_response(
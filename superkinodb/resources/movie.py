@@ -1,14 +1,14 @@
-import json
 from datetime import datetime
 from datetime import date
-from jsonschema import validate, ValidationError, draft7_format_checker
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
 from superkinodb import db
-from superkinodb.db_models import Movie, Actor, Director, Writer
+from superkinodb.db_models import Movie, Actor, Director, Writer, movie_actors, movie_directors, movie_writers
 from superkinodb.consts import *
-from superkinodb.utils import SuperkinodbBuilder, error_response, add_person 
+from superkinodb.utils import MasonBuilder, SuperkinodbBuilder, error_response, paginate, add_total_count, cached_response, conditional_response, table_stamp, row_stamp, resolve_persons, resolve_credits, iter_json_items, validate_json, url_template, stream_format, stream_collection, encode_json
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
 
@@ -22,9 +22,68 @@ class MovieConverter(BaseConverter):
     def to_url(self, db_item):
         return db_item.name
 
+def _date_arg(param):
+    value = request.args.get(param)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError("{} must be a date in format YYYY-MM-DD".format(param))
+
+def filter_movies(query):
+    """
+    Applies the filters given as query parameters to a movie query. Every
+    filter can be served from an index: genre from (genre, name), the release
+    range from release and the credited persons from their unique name and
+    the reverse index of the association table.
+
+    Raises ValueError if a filter value is invalid.
+    """
+
+    genre = request.args.get("genre")
+    if genre is not None:
+        query = query.filter(Movie.genre == genre)
+
+    released_after = _date_arg("released_after")
+    if released_after is not None:
+        query = query.filter(Movie.release >= released_after)
+
+    released_before = _date_arg("released_before")
+    if released_before is not None:
+        query = query.filter(Movie.release <= released_before)
+
+    for param, PersonObject, secondary in (
+            ("actor", Actor, movie_actors),
+            ("director", Director, movie_directors),
+            ("writer", Writer, movie_writers)):
+        for i, name in enumerate(request.args.getlist(param)):
+            link = secondary.alias("{}_link_{}".format(param, i))
+            person = PersonObject.__table__.alias("{}_{}".format(param, i))
+            query = query.join(link, link.c.movie_id == Movie.id).join(
+                person,
+                (person.c.id == link.c[param + "_id"]) & (person.c.name == name)
+            )
+    return query
+
 class MovieCollection(Resource):
+    @conditional_response(lambda: table_stamp("movie"))
+    @cached_response("movies")
     def get(self):
-        movies = Movie.query.order_by(Movie.name)
+        try:
+            query = filter_movies(Movie.query)
+            stream = stream_format()
+            if not stream:
+                movies, prev_key, next_key = paginate(
+                    query.options(*Movie.load_options(short_form=True)),
+                    Movie.name
+                )
+        except ValueError as e:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                str(e)
+            )
 
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
@@ -34,15 +93,28 @@ class MovieCollection(Resource):
         body.add_control_all_directors()
         body.add_control_all_writers()
 
-        body["movies"] = []
-
-        for movie in movies:
+        movie_url = url_template("api.movieitem", "movie")
+        def movie_item(movie):
             item = SuperkinodbBuilder()
-            item.add_control("self", url_for("api.movieitem", movie=movie))
+            item.add_control("self", movie_url(movie.name))
             item["data"] = movie.serialize(short_form=True)
-            body["movies"].append(item)
+            return item
+
+        if stream:
+            resp = stream_collection(
+                body,
+                "movies",
+                query.options(*Movie.load_options(short_form=True)).order_by(Movie.name),
+                movie_item,
+                stream
+            )
+            return add_total_count(resp, query, Movie.name)
+
+        body.add_control_pagination("api.moviecollection", prev_key, next_key)
+        body["movies"] = [movie_item(movie) for movie in movies]
         
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        resp = Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+        return add_total_count(resp, query, Movie.name)
 
     def post(self):
         if not request.json:
@@ -53,7 +125,7 @@ class MovieCollection(Resource):
             )
         
         try:
-            validate(request.json, Movie.get_schema(), format_checker=draft7_format_checker)
+            validate_json(request.json, Movie)
             release = request.json.get('release')
             if release:
                 release_date = datetime.strptime(release, '%Y-%m-%d').date()
@@ -82,26 +154,9 @@ class MovieCollection(Resource):
                 "Movies must be named uniquely"
             )
 
-        for item in request.json.get("actors", []):
-            actor = Actor.query.filter_by(name=item).first()
-            if actor is None:
-                actor = add_person(Actor, item)
-            
-            movie.actors.append(actor)
-
-        for item in request.json.get("directors", []):
-            director = Director.query.filter_by(name=item).first()
-            if director is None:
-                director = add_person(Director, item)
-            
-            movie.directors.append(director)
-
-        for item in request.json.get("writers", []):
-            writer = Writer.query.filter_by(name=item).first()
-            if writer is None:
-                writer = add_person(Writer, item)
-            
-            movie.writers.append(writer)
+        movie.actors = resolve_credits(Actor, request.json.get("actors", []))
+        movie.directors = resolve_credits(Director, request.json.get("directors", []))
+        movie.writers = resolve_credits(Writer, request.json.get("writers", []))
 
         try:
             db.session.commit()
@@ -133,6 +188,8 @@ class MovieCollection(Resource):
         return resp
 
 class MovieItem(Resource):
+    @conditional_response(lambda movie: row_stamp(movie))
+    @cached_response("movie:{movie.name}")
     def get(self, movie):
         body = SuperkinodbBuilder()
         body["data"] = movie.serialize()
@@ -142,7 +199,7 @@ class MovieItem(Resource):
         body.add_control_edit_movie(movie)
         body.add_control_delete_movie(movie)
         body.add_control_movie_reviews(movie)
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
 
     def post(self, movie):
         resp = error_response(
@@ -162,7 +219,7 @@ class MovieItem(Resource):
             )
         
         try:
-            validate(request.json, Movie.get_schema(), format_checker=draft7_format_checker)
+            validate_json(request.json, Movie)
             release = request.json.get('release')
             
             if release:
@@ -182,32 +239,9 @@ class MovieItem(Resource):
         movie.genre = request.json.get("genre", "")
 
         try:
-            actors = []
-            for item in request.json.get("actors", []):
-                actor = Actor.query.filter_by(name=item).first()
-                if actor is None:
-                    actor = add_person(Actor, item)
-                actors.append(actor)
-            
-            movie.actors = actors
-
-            directors = []
-            for item in request.json.get("directors", []):
-                director = Director.query.filter_by(name=item).first()
-                if director is None:
-                    director = add_person(Director, item)
-                directors.append(director)
-
-            movie.directors = directors
-            
-            writers = []
-            for item in request.json.get("writers", []):
-                writer = Writer.query.filter_by(name=item).first()
-                if writer is None:
-                    writer = add_person(Writer, item)
-                writers.append(writer)
-            
-            movie.writers = writers
+            movie.actors = resolve_credits(Actor, request.json.get("actors", []))
+            movie.directors = resolve_credits(Director, request.json.get("directors", []))
+            movie.writers = resolve_credits(Writer, request.json.get("writers", []))
 
             db.session.commit()
         except IntegrityError as e: return error_response(
@@ -229,3 +263,214 @@ class MovieItem(Resource):
                 str(e)
             )
         return Response(status=204)
+
+class MovieBulk(Resource):
+    def get(self):
+        """
+        Returns the full data of every movie named with a name query
+        parameter, in the given order. The movies are fetched with one
+        query and their credits with one query per person type. Names
+        without a movie get a 404 result of their own.
+        """
+
+        names = request.args.getlist("name")
+        if not names or len(names) > BULK_GET_LIMIT:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                "Give from 1 to {} movie names as name parameters".format(BULK_GET_LIMIT)
+            )
+
+        movies = {
+            movie.name: movie
+            for movie in Movie.query.options(*Movie.load_options()).filter(Movie.name.in_(set(names)))
+        }
+
+        movie_url = url_template("api.movieitem", "movie")
+        results = []
+        for index, name in enumerate(names):
+            movie = movies.get(name)
+            if movie is None:
+                results.append(self._error_result(
+                    index, name, 404, "Not found", "No movie named {}".format(name)
+                ))
+                continue
+            result = SuperkinodbBuilder(index=index, name=name, status=200)
+            result.add_control("self", movie_url(name))
+            result["data"] = movie.serialize()
+            results.append(result)
+
+        body = SuperkinodbBuilder()
+        body.add_namespace("superkinodb", LINK_RELATIONS)
+        body.add_control("self", url_for("api.moviebulk", name=names))
+        body.add_control_all_movies()
+        body["found"] = sum(1 for result in results if result["status"] == 200)
+        body["missing"] = len(results) - body["found"]
+        body["results"] = results
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+
+    def post(self):
+        if request.mimetype not in ("application/json", "application/x-ndjson"):
+            return error_response(
+                415,
+                "Unsupported media type",
+                "Requests must be a JSON array or newline delimited JSON"
+            )
+
+        items = iter_json_items(
+            request.stream,
+            ndjson=request.mimetype == "application/x-ndjson"
+        )
+        results = []
+        seen = set()
+        batch = []
+        for index, (item, error) in enumerate(items):
+            batch.append((index, item, error))
+            if len(batch) >= BULK_BATCH_SIZE:
+                results.extend(self._insert_batch(batch, seen))
+                batch = []
+        if batch:
+            results.extend(self._insert_batch(batch, seen))
+
+        body = SuperkinodbBuilder()
+        body.add_namespace("superkinodb", LINK_RELATIONS)
+        body.add_control("self", url_for("api.moviebulk"))
+        body.add_control_all_movies()
+        body["created"] = sum(1 for result in results if result["status"] == 201)
+        body["failed"] = len(results) - body["created"]
+        body["results"] = results
+        # Nothing was written, the client must not take it for a success
+        status = 400 if body["failed"] and not body["created"] else 200
+        return Response(encode_json(body), status, mimetype="application/vnd.mason+json")
+
+    def put(self):
+        resp = error_response(
+                405,
+                "Method not allowed",
+                "Request not supported for this resource"
+            )
+        resp.headers["Allow"] = "GET, POST"
+        return resp
+
+    def delete(self):
+        resp = error_response(
+                405,
+                "Method not allowed",
+                "Request not supported for this resource"
+            )
+        resp.headers["Allow"] = "GET, POST"
+        return resp
+
+    @staticmethod
+    def _error_result(index, name, status, title, message):
+        result = MasonBuilder(index=index, name=name, status=status)
+        result.add_error(title, message)
+        return result
+
+    def _insert_batch(self, batch, seen):
+        """
+        Validates one batch of movies and inserts the valid ones with
+        _write_movies. Returns the results of the batch in input order.
+        """
+
+        results = {}
+        valid = []
+        for index, item, error in batch:
+            if error is not None:
+                results[index] = self._error_result(index, None, 400, "Invalid JSON", error)
+                continue
+            name = item.get("name") if isinstance(item, dict) else None
+            try:
+                validate_json(item, Movie)
+            except ValidationError as e:
+                results[index] = self._error_result(index, name, 400, "Invalid JSON schema", str(e))
+                continue
+            if name in seen:
+                results[index] = self._error_result(
+                    index, name, 409,
+                    "Movie {} already exists".format(name),
+                    "Movies must be named uniquely"
+                )
+                continue
+            seen.add(name)
+            valid.append((index, item))
+
+        results.update(self._write_movies(valid))
+        return [results[index] for index, item, error in batch]
+
+    def _write_movies(self, valid):
+        """
+        Inserts validated movies as (index, item) pairs in a single
+        transaction. Persons referenced by the movies are resolved with one
+        query per person type. If the transaction fails on a conflict, e.g. with a
+        movie inserted concurrently, the movies are retried one at a time
+        so that only the conflicting ones fail. Returns a dictionary of
+        index -> result.
+        """
+
+        results = {}
+        with db.session.no_autoflush:
+            existing = {
+                movie.name
+                for movie in Movie.query.filter(
+                    Movie.name.in_([item["name"] for index, item in valid])
+                ).options(load_only(Movie.name))
+            }
+            new = []
+            for index, item in valid:
+                if item["name"] in existing:
+                    results[index] = self._error_result(
+                        index, item["name"], 409,
+                        "Movie {} already exists".format(item["name"]),
+                        "Movies must be named uniquely"
+                    )
+                    continue
+                new.append((index, item))
+
+            # Only the persons of the movies that are inserted, so that
+            # rejected movies don't leave uncredited persons behind
+            actors = resolve_persons(
+                Actor, (name for index, item in new for name in item.get("actors", []))
+            )
+            directors = resolve_persons(
+                Director, (name for index, item in new for name in item.get("directors", []))
+            )
+            writers = resolve_persons(
+                Writer, (name for index, item in new for name in item.get("writers", []))
+            )
+
+            movies = []
+            for index, item in new:
+                release = item.get("release")
+                movie = Movie(
+                    name=item["name"],
+                    release=datetime.strptime(release, '%Y-%m-%d').date() if release else date.today(),
+                    genre=item.get("genre"),
+                )
+                movie.actors = [actors[name] for name in dict.fromkeys(item.get("actors", []))]
+                movie.directors = [directors[name] for name in dict.fromkeys(item.get("directors", []))]
+                movie.writers = [writers[name] for name in dict.fromkeys(item.get("writers", []))]
+                db.session.add(movie)
+                movies.append((index, movie))
+
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if len(new) == 1:
+                index, item = new[0]
+                results[index] = self._error_result(
+                    index, item["name"], 409, "Database conflict", str(e.orig)
+                )
+            else:
+                # Find the conflicting movies by inserting one at a time
+                for index_item in new:
+                    results.update(self._write_movies([index_item]))
+        else:
+            movie_url = url_template("api.movieitem", "movie")
+            for index, movie in movies:
+                result = MasonBuilder(index=index, name=movie.name, status=201)
+                result.add_control("self", movie_url(movie.name))
+                results[index] = result
+
+        return results
@@ -1,12 +1,11 @@
-import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 from superkinodb import db
-from superkinodb.db_models import Review, Movie
+from superkinodb.db_models import Review
 from superkinodb.consts import *
-from superkinodb.utils import SuperkinodbBuilder, error_response
+from superkinodb.utils import SuperkinodbBuilder, error_response, cached_response, conditional_response, table_stamp, row_stamp, validate_json, url_template, stream_format, stream_collection, encode_json
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import NotFound
 
@@ -21,9 +20,19 @@ class ReviewConverter(BaseConverter):
         return review.reviewer
 
 class ReviewCollection(Resource):
+    @conditional_response(lambda movie: table_stamp("review", "movie"))
+    @cached_response("reviews:{movie.name}")
     def get(self, movie):
-        reviews = Review.query.filter_by(movie=movie)
-        movie_item = Movie.query.filter_by(name=movie.name).first()
+        reviews = Review.query.filter_by(movie=movie).order_by(Review.reviewer)
+        movie_item = movie
+        try:
+            stream = stream_format()
+        except ValueError as e:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                str(e)
+            )
 
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
@@ -31,15 +40,25 @@ class ReviewCollection(Resource):
         body.add_control("movie", url_for("api.movieitem", movie=movie))
         body.add_control_add_review(movie_item=movie)
 
-        body["reviews"] = []
-
-        for review_item in reviews:
+        review_url = url_template("api.reviewitem", "movie", "review")
+        def review_item(review):
             item = SuperkinodbBuilder()
-            item.add_control("self", url_for("api.reviewitem", movie=movie_item, review=review_item))
-            item["data"] = review_item.serialize(short_form=True)
-            body["reviews"].append(item)
+            item.add_control("self", review_url(movie_item.name, review.reviewer))
+            item["data"] = review.serialize(short_form=True)
+            return item
+
+        if stream:
+            return stream_collection(
+                body,
+                "reviews",
+                reviews,
+                review_item,
+                stream
+            )
+
+        body["reviews"] = [review_item(review) for review in reviews]
 
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
 
     def post(self, movie):
         if not request.json:
@@ -50,7 +69,7 @@ class ReviewCollection(Resource):
             )
 
         try:
-            validate(request.json, Review.get_schema())
+            validate_json(request.json, Review)
         except ValidationError as e:
             return error_response(
                 400,
@@ -110,6 +129,8 @@ class ReviewCollection(Resource):
         resp.headers["Allow"] = "GET, POST"
         return resp
 class ReviewItem(Resource):
+    @conditional_response(lambda review, movie: row_stamp(review))
+    @cached_response("reviews:{movie.name}")
     def get(self, review, movie):
 
         body = SuperkinodbBuilder()
@@ -120,7 +141,7 @@ class ReviewItem(Resource):
         body.add_control_edit_review(movie_item=movie, review_item=review)
         body.add_control_delete_review(movie_item=movie, review_item=review)
 
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
 
     def post(self, review, movie):
         resp = error_response(
@@ -140,7 +161,7 @@ class ReviewItem(Resource):
             )
 
         try:
-            validate(request.json, Review.get_schema())
+            validate_json(request.json, Review)
         except ValidationError as e:
             return error_response(
                 400,
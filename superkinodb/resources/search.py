@@ -0,0 +1,150 @@
+from flask import Response, request, url_for
+from flask_restful import Resource
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from superkinodb import db
+from superkinodb.consts import *
+from superkinodb.utils import SuperkinodbBuilder, error_response, url_template, cached_response, conditional_response, table_stamp, encode_json
+
+SEARCH_QUERIES = {
+    "movie": (
+        "SELECT 'movie' AS type, movie.name AS movie, NULL AS reviewer, "
+        "movie.genre AS genre, NULL AS snippet, bm25(movie_fts) AS rank "
+        "FROM movie_fts JOIN movie ON movie.id = movie_fts.rowid "
+        "WHERE movie_fts MATCH :query"
+    ),
+    "review": (
+        "SELECT 'review' AS type, review.movie_name AS movie, review.reviewer AS reviewer, "
+        "NULL AS genre, snippet(review_fts, 0, '[', ']', '...', 12) AS snippet, "
+        "bm25(review_fts) AS rank "
+        "FROM review_fts JOIN review ON review.id = review_fts.rowid "
+        "WHERE review_fts MATCH :query"
+    ),
+}
+
+def _match_expression(terms):
+    # Every term is quoted so that user input is never parsed as FTS5 query
+    # syntax, the terms are combined with an implicit AND
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms.split())
+
+class SearchCollection(Resource):
+    @conditional_response(lambda: table_stamp("movie", "review"))
+    @cached_response("search")
+    def get(self):
+        """
+        Full-text search over movie names and genres and review texts. Results
+        are ordered by relevance, which has to be computed for every match
+        anyway, so they are paged with a plain offset instead of a cursor.
+        """
+
+        query = _match_expression(request.args.get("q", ""))
+        types = request.args.getlist("type") or list(SEARCH_QUERIES)
+        try:
+            limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+            offset = int(request.args.get("offset", 0))
+        except ValueError:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                "limit and offset must be integers"
+            )
+        if not query:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                "Search terms must be given with q"
+            )
+        if any(t not in SEARCH_QUERIES for t in types):
+            return error_response(
+                400,
+                "Invalid query parameters",
+                "type must be one of: {}".format(", ".join(SEARCH_QUERIES))
+            )
+        if limit < 1 or limit > MAX_PAGE_SIZE or offset < 0:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                "limit must be between 1 and {} and offset can't be negative".format(MAX_PAGE_SIZE)
+            )
+
+        stmt = text(
+            " UNION ALL ".join(SEARCH_QUERIES[t] for t in types)
+            + " ORDER BY rank, type, movie, reviewer LIMIT :limit OFFSET :offset"
+        )
+        try:
+            rows = db.session.execute(
+                stmt,
+                {"query": query, "limit": limit + 1, "offset": offset}
+            ).all()
+        except OperationalError as e:
+            return error_response(
+                400,
+                "Invalid search query",
+                str(e.orig)
+            )
+
+        body = SuperkinodbBuilder()
+        body.add_namespace("superkinodb", LINK_RELATIONS)
+        args = request.args.to_dict(flat=False)
+        body.add_control("self", url_for("api.searchcollection", **args))
+        body.add_control_all_movies()
+        args.pop("offset", None)
+        if offset > 0:
+            body.add_control(
+                "prev",
+                url_for("api.searchcollection", offset=max(offset - limit, 0), **args),
+                title="Previous page"
+            )
+        if len(rows) > limit:
+            body.add_control(
+                "next",
+                url_for("api.searchcollection", offset=offset + limit, **args),
+                title="Next page"
+            )
+
+        body["results"] = []
+        movie_url = url_template("api.movieitem", "movie")
+        review_url = url_template("api.reviewitem", "movie", "review")
+        for row in rows[:limit]:
+            item = SuperkinodbBuilder()
+            if row.type == "movie":
+                item.add_control("self", movie_url(row.movie))
+                item["data"] = {"type": row.type, "name": row.movie, "genre": row.genre}
+            else:
+                item.add_control("self", review_url(row.movie, row.reviewer))
+                item["data"] = {
+                    "type": row.type,
+                    "movie": row.movie,
+                    "reviewer": row.reviewer,
+                    "snippet": row.snippet
+                }
+            body["results"].append(item)
+
+        return Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+
+    def post(self):
+        resp = error_response(
+                405,
+                "Method not allowed",
+                "Request not supported for this resource"
+            )
+        resp.headers["Allow"] = "GET"
+        return resp
+
+    def put(self):
+        resp = error_response(
+                405,
+                "Method not allowed",
+                "Request not supported for this resource"
+            )
+        resp.headers["Allow"] = "GET"
+        return resp
+
+    def delete(self):
+        resp = error_response(
+                405,
+                "Method not allowed",
+                "Request not supported for this resource"
+            )
+        resp.headers["Allow"] = "GET"
+        return resp
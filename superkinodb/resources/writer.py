@@ -1,13 +1,27 @@
-import json
 from flask import Response, url_for
 from flask_restful import Resource
 from superkinodb.db_models import Writer
 from superkinodb.consts import *
-from superkinodb.utils import SuperkinodbBuilder, error_response
+from superkinodb.utils import SuperkinodbBuilder, error_response, paginate, add_total_count, cached_response, conditional_response, table_stamp, stream_format, stream_collection, encode_json
 
 class WriterCollection(Resource):
+    @conditional_response(lambda: table_stamp("writer", "movie"))
+    @cached_response("writers")
     def get(self):
-        writers = Writer.query.order_by(Writer.name)
+        query = Writer.query
+        try:
+            stream = stream_format()
+            if not stream:
+                writers, prev_key, next_key = paginate(
+                    query.options(*Writer.load_options()),
+                    Writer.name
+                )
+        except ValueError as e:
+            return error_response(
+                400,
+                "Invalid query parameters",
+                str(e)
+            )
 
         body = SuperkinodbBuilder()
         body.add_namespace("superkinodb", LINK_RELATIONS)
@@ -16,12 +30,24 @@ class WriterCollection(Resource):
         body.add_control_all_actors()
         body.add_control_all_directors()
 
+        if stream:
+            resp = stream_collection(
+                body,
+                "writers",
+                query.options(*Writer.load_options()).order_by(Writer.name),
+                Writer.serialize,
+                stream
+            )
+            return add_total_count(resp, query, Writer.name)
+
+        body.add_control_pagination("api.writercollection", prev_key, next_key)
         body["writers"] = []
 
         for writer in writers: 
             body["writers"].append(writer.serialize())
 
-        return Response(json.dumps(body), 200, mimetype="application/vnd.mason+json")
+        resp = Response(encode_json(body), 200, mimetype="application/vnd.mason+json")
+        return add_total_count(resp, query, Writer.name)
 
     def post(self):
         resp = error_response(
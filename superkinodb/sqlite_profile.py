@@ -0,0 +1,97 @@
+"""
+Connection settings of the SQLite database. The pragmas in SQLITE_PRAGMAS
+are applied to every new connection, and at startup the settings in effect
+are read back and logged, with a warning for every one that SQLite didn't
+accept (e.g. WAL on a network file system or an in-memory database). The
+connection pool of a file database is sized with SQLITE_POOL_OPTIONS.
+"""
+
+import logging
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger("superkinodb.sqlite")
+
+# Values some pragmas are read back as
+PRAGMA_VALUES = {
+    "synchronous": {"off": 0, "normal": 1, "full": 2, "extra": 3},
+    "temp_store": {"default": 0, "file": 1, "memory": 2},
+    "foreign_keys": {"off": 0, "on": 1, "false": 0, "true": 1, "no": 0, "yes": 1},
+}
+
+def _order(pragmas):
+    # The busy timeout must be in place before journal_mode, which may have
+    # to wait for other connections
+    return sorted(pragmas.items(), key=lambda item: item[0] != "busy_timeout")
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in _order(pragmas):
+            cursor.execute("PRAGMA {}={}".format(name, value))
+    finally:
+        cursor.close()
+
+def _normalize(name, value):
+    if isinstance(value, str):
+        value = value.lower()
+        value = PRAGMA_VALUES.get(name, {}).get(value, value)
+    return value
+
+def check_pragmas(connection, pragmas):
+    """
+    Reads back the pragmas of a connection. Returns a dictionary of name ->
+    (requested value, value in effect, whether they match).
+    """
+
+    report = {}
+    for name, requested in _order(pragmas):
+        in_effect = connection.exec_driver_sql("PRAGMA {}".format(name)).scalar()
+        report[name] = (requested, in_effect, _normalize(name, requested) == _normalize(name, in_effect))
+    return report
+
+def _startup_check(engine, pragmas):
+    with engine.connect() as connection:
+        report = check_pragmas(connection, pragmas)
+    # Don't hand the checked connection down to forked worker processes
+    engine.dispose()
+    return report
+
+def add_pool_options(app):
+    """
+    Adds SQLITE_POOL_OPTIONS to SQLALCHEMY_ENGINE_OPTIONS, which take
+    precedence, for a file database. An in-memory database is served from
+    one static connection that doesn't take pool options.
+    """
+
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    if url.get_backend_name() != "sqlite" or "poolclass" in options:
+        return
+    if url.database in (None, "", ":memory:") or url.query.get("mode") == "memory":
+        return
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(app.config["SQLITE_POOL_OPTIONS"], **options)
+
+def init_app(app, db):
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+
+    if engine.dialect.is_async:
+        from superkinodb.asgi import run_in_greenlet
+        report = run_in_greenlet(_startup_check, engine, pragmas)
+    else:
+        report = _startup_check(engine, pragmas)
+
+    logger.info("SQLite settings in effect: %s", ", ".join(
+        "{}={}".format(name, in_effect) for name, (requested, in_effect, ok) in report.items()
+    ))
+    for name, (requested, in_effect, ok) in report.items():
+        if not ok:
+            logger.warning("SQLite %s is %s instead of %s", name, in_effect, requested)
@@ -1,8 +1,21 @@
+import codecs
+import hashlib
 import json
-from flask import Response, request, url_for
-from superkinodb import db
+import uuid
+from functools import wraps
+from itertools import islice
+from flask import Response, current_app, has_request_context, request, stream_with_context, url_for
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from superkinodb import db, cache
+from superkinodb.consts import *
 from superkinodb.db_models import *
-from sqlalchemy import all_, event
+from superkinodb.instrumentation import timed
+from superkinodb.metrics import count_cache_lookup
+from superkinodb.replicas import read_source
+from sqlalchemy import all_, case, delete, event, exists, func, inspect, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm.util import identity_key
 
 class MasonBuilder(dict):
     """
@@ -70,119 +83,886 @@ class MasonBuilder(dict):
 
 class SuperkinodbBuilder(MasonBuilder):
 
+    def add_control_pagination(self, endpoint, prev_key, next_key, **values):
+        """
+        Adds "prev" and "next" controls for a keyset paginated collection.
+        Query parameters of the current request (filters, limit) are carried
+        over to the links, only the cursor is replaced.
+
+        : param str endpoint: endpoint of the collection resource
+        : param str prev_key: cursor for the previous page or None
+        : param str next_key: cursor for the next page or None
+        """
+
+        args = request.args.to_dict(flat=False)
+        args.pop("after", None)
+        args.pop("before", None)
+        args.pop("count", None)
+        args.update(values)
+        if prev_key is not None:
+            self.add_control(
+                "prev",
+                url_for(endpoint, before=prev_key, **args),
+                title="Previous page"
+            )
+        if next_key is not None:
+            self.add_control(
+                "next",
+                url_for(endpoint, after=next_key, **args),
+                title="Next page"
+            )
+
+    def add_prebuilt_control(self, key, *names):
+        """
+        Adds one of the controls in CONTROLS. Everything but the href is
+        built once per app, the href is filled in from a URL template.
+
+        : param str key: key of the control in CONTROLS
+        : param names: values of the view arguments of the href, e.g. the
+            name of a movie
+        """
+
+        ctrl_name, href, props = _prebuilt_controls()[key]
+        control = dict(props)
+        control["href"] = href(*names)
+        if "@controls" not in self:
+            self["@controls"] = {}
+        self["@controls"][ctrl_name] = control
+
     def add_control_all_movies(self):
-        self.add_control(
-            "superkinodb:movies",
-            url_for("api.moviecollection"),
-            title="All movies"
-        )
+        self.add_prebuilt_control("all_movies")
     def add_control_all_actors(self):
-        self.add_control(
-            "superkinodb:actors",
-            url_for("api.actorcollection"),
-            title="All actors"
-        )
+        self.add_prebuilt_control("all_actors")
     def add_control_all_directors(self):
-        self.add_control(
-            "superkinodb:directors",
-            url_for("api.directorcollection"),
-            title="All directors"
-        )
+        self.add_prebuilt_control("all_directors")
     def add_control_all_writers(self):
-        self.add_control(
-            "superkinodb:writers",
-            url_for("api.writercollection"),
-            title="All writers"
-        )
+        self.add_prebuilt_control("all_writers")
     def add_control_add_movie(self):
-        self.add_control(
-            "add_movie",
-            url_for("api.moviecollection"),
-            method="POST",
-            encoding="json",
-            title="Add a movie to the database",
-            schema=Movie.get_schema()
-        )
+        self.add_prebuilt_control("add_movie")
     def add_control_edit_movie(self, movie_item):
-        self.add_control(
-            "edit_movie",
-            url_for("api.movieitem", movie=movie_item),
-            method="PUT",
-            encoding="json",
-            title="Edit a movie in the database",
-            schema=movie_item.get_schema()
-        )
+        self.add_prebuilt_control("edit_movie", movie_item.name)
     def add_control_delete_movie(self, movie_item):
-        self.add_control(
-            "delete_movie",
-            url_for("api.movieitem", movie=movie_item),
-            method="DELETE",
-            title="Delete a movie from the database"
-        )
+        self.add_prebuilt_control("delete_movie", movie_item.name)
     def add_control_movie_reviews(self, movie_item):
-        self.add_control(
-            "reviews",
-            url_for("api.reviewcollection", movie=movie_item),
-            title="Movie review collection"
-        )
+        self.add_prebuilt_control("movie_reviews", movie_item.name)
     def add_control_add_review(self, movie_item):
-        self.add_control(
-            "add_review",
-            url_for("api.reviewcollection", movie=movie_item),
-            method="POST",
-            encoding="json",
-            title="Add review",
-            schema=Review.get_schema()
-        )
+        self.add_prebuilt_control("add_review", movie_item.name)
     def add_control_edit_review(self, movie_item, review_item):
-        self.add_control(
-            "edit_review",
-            url_for("api.reviewitem", movie=movie_item, review=review_item),
-            method="PUT",
-            encoding="json",
-            title="Edit review",
-            schema=Review.get_schema()
-        )
+        self.add_prebuilt_control("edit_review", movie_item.name, review_item.reviewer)
     def add_control_delete_review(self, movie_item, review_item):
-        self.add_control(
-            "delete_review",
-            url_for("api.reviewitem", movie=movie_item, review=review_item),
-            method="DELETE",
-            title="Delete review"
+        self.add_prebuilt_control("delete_review", movie_item.name, review_item.reviewer)
+
+# Controls added by SuperkinodbBuilder: key -> (control name, endpoint, view
+# arguments of the href, other properties). A model given as the schema is
+# replaced with its registered schema.
+CONTROLS = {
+    "all_movies": ("superkinodb:movies", "api.moviecollection", (), {"title": "All movies"}),
+    "all_actors": ("superkinodb:actors", "api.actorcollection", (), {"title": "All actors"}),
+    "all_directors": ("superkinodb:directors", "api.directorcollection", (), {"title": "All directors"}),
+    "all_writers": ("superkinodb:writers", "api.writercollection", (), {"title": "All writers"}),
+    "add_movie": ("add_movie", "api.moviecollection", (), {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add a movie to the database",
+        "schema": Movie
+    }),
+    "edit_movie": ("edit_movie", "api.movieitem", ("movie",), {
+        "method": "PUT",
+        "encoding": "json",
+        "title": "Edit a movie in the database",
+        "schema": Movie
+    }),
+    "delete_movie": ("delete_movie", "api.movieitem", ("movie",), {
+        "method": "DELETE",
+        "title": "Delete a movie from the database"
+    }),
+    "movie_reviews": ("reviews", "api.reviewcollection", ("movie",), {
+        "title": "Movie review collection"
+    }),
+    "add_review": ("add_review", "api.reviewcollection", ("movie",), {
+        "method": "POST",
+        "encoding": "json",
+        "title": "Add review",
+        "schema": Review
+    }),
+    "edit_review": ("edit_review", "api.reviewitem", ("movie", "review"), {
+        "method": "PUT",
+        "encoding": "json",
+        "title": "Edit review",
+        "schema": Review
+    }),
+    "delete_review": ("delete_review", "api.reviewitem", ("movie", "review"), {
+        "method": "DELETE",
+        "title": "Delete review"
+    }),
+}
+
+class _UrlPlaceholder:
+    """
+    Stands in for a model object when a URL template is built. The URL
+    converters read the identifying attribute of their object, which gives
+    the marker of the slot.
+    """
+
+    def __init__(self, index):
+        self.marker = "\x00{}\x00".format(index)
+
+    def __getattr__(self, name):
+        return self.marker
+
+def _app_registry(name):
+    # Per app and script root, since both change what url_for returns
+    registry = current_app.extensions.setdefault("superkinodb." + name, {})
+    script_root = request.script_root if has_request_context() else None
+    return registry.setdefault(script_root, {})
+
+def url_template(endpoint, *args):
+    """
+    Returns a function that builds URLs of *endpoint* from the names of the
+    objects in its view arguments, in the order of *args*, e.g.
+
+        review_url = url_template("api.reviewitem", "movie", "review")
+        review_url(movie.name, review.reviewer)
+
+    The URL is built with url_for once and the names are then just inserted
+    into it, which is much cheaper when linking every item of a collection.
+    Only works with converters that put the name into the URL as is, like
+    the ones of this API.
+    """
+
+    templates = _app_registry("url_templates")
+    key = (endpoint, args)
+    if key not in templates:
+        placeholders = [_UrlPlaceholder(i) for i in range(len(args))]
+        url = url_for(endpoint, **dict(zip(args, placeholders)))
+        url = url.replace("{", "{{").replace("}", "}}")
+        for i, placeholder in enumerate(placeholders):
+            if placeholder.marker not in url:
+                raise ValueError("Converter of {} changes the value".format(args[i]))
+            url = url.replace(placeholder.marker, "{%d}" % i)
+        templates[key] = url.format
+    return templates[key]
+
+def _prebuilt_controls():
+    controls = _app_registry("controls")
+    if not controls:
+        for key, (ctrl_name, endpoint, args, props) in CONTROLS.items():
+            props = dict(props)
+            if "schema" in props:
+                props["schema"] = get_schema(props["schema"])
+            controls[key] = (ctrl_name, url_template(endpoint, *args), props)
+    return controls
+
+_validators = {}
+
+def register_schemas():
+    """
+    Builds the JSON schemas of the models once and compiles a validator for
+    each of them. Called at app start so that requests only run the
+    validation itself.
+    """
+
+    for model in (Movie, Review):
+        schema = model.get_schema()
+        Draft7Validator.check_schema(schema)
+        _validators[model] = Draft7Validator(
+            schema,
+            format_checker=Draft7Validator.FORMAT_CHECKER
         )
+
+def get_schema(model):
+    """
+    Returns the shared, prebuilt JSON schema of a model. The returned
+    dictionary must not be modified.
+    """
+
+    return get_validator(model).schema
+
+def get_validator(model):
+    """
+    Returns the compiled validator for the JSON schema of a model.
+    """
+
+    if model not in _validators:
+        register_schemas()
+    return _validators[model]
+
+def validate_json(instance, model):
+    """
+    Validates a request document against the schema of a model. Raises the
+    same ValidationError as jsonschema.validate, but without checking the
+    schema and building a validator on every call.
+    """
+
+    with timed("validation"):
+        error = best_match(get_validator(model).iter_errors(instance))
+    if error is not None:
+        raise error
+
+def encode_json(body):
+    """
+    Encodes a response body as JSON, timed when instrumentation is on.
+    """
+
+    with timed("json"):
+        return json.dumps(body)
+
 def error_response(status_code, text, error_message):
     url = request.url
     body = MasonBuilder(url=url)
     body.add_error(text, error_message)
-    return Response(json.dumps(body), status_code, mimetype="application/vnd.mason+json")
+    return Response(encode_json(body), status_code, mimetype="application/vnd.mason+json")
+
+def paginate(query, column):
+    """
+    Returns one page of *query* using keyset pagination on *column*, which
+    must be unique and indexed. The page is selected with the "limit",
+    "after" and "before" query parameters, so the cost of a page does not
+    depend on how deep into the collection the client is.
+
+    Raises ValueError if the query parameters are invalid.
+
+    : param query: query for the whole collection, without ordering
+    : param column: unique column used as the cursor
+    : return: tuple (rows, prev_key, next_key) where the keys are cursors for
+        the neighbouring pages or None if there is no such page
+    """
+
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise ValueError("after and before can't be used together")
+
+    prev_key = next_key = None
+    if before is not None:
+        rows = query.filter(column < before).order_by(column.desc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        if rows:
+            # The cursor may be past the last row of the collection
+            later = query.filter(column >= before).order_by(column).limit(1)
+            if later.first() is not None:
+                next_key = getattr(rows[-1], column.key)
+            if has_more:
+                prev_key = getattr(rows[0], column.key)
+    else:
+        rows = query
+        if after is not None:
+            rows = rows.filter(column > after)
+        rows = rows.order_by(column).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            if has_more:
+                next_key = getattr(rows[-1], column.key)
+            # The cursor may be before the first row of the collection
+            if after is not None:
+                earlier = query.filter(column <= after).order_by(column.desc()).limit(1)
+                if earlier.first() is not None:
+                    prev_key = getattr(rows[0], column.key)
+
+    return rows, prev_key, next_key
+
+def add_total_count(response, query, column):
+    """
+    Adds the X-Total-Count header to *response* if the client asked for it
+    with "count=true". The count is done in the database without loading any
+    rows.
+    """
+
+    if request.args.get("count", "").lower() in ("1", "true"):
+        total = query.order_by(None).with_entities(func.count(column)).scalar()
+        response.headers["X-Total-Count"] = str(total)
+    return response
+
+def stream_format():
+    """
+    Returns the streaming mode asked for with the "stream" query parameter:
+    None for a normal paginated response, "mason" or "ndjson".
+
+    Raises ValueError if the parameter is invalid.
+    """
+
+    stream = request.args.get("stream")
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise ValueError("stream must be one of: {}".format(", ".join(STREAM_FORMATS)))
+    return stream
+
+def stream_collection(body, key, query, serialize, stream):
+    """
+    Returns a chunked response with every row of *query*. Rows are fetched
+    and written STREAM_BATCH_SIZE at a time, so memory use and the time to
+    the first byte don't depend on the size of the collection.
+
+    In "mason" mode the envelope *body* is written first and the serialized
+    rows follow as the list *key* of it. In "ndjson" mode only the rows are
+    written, one JSON document per line.
+
+    : param body: Mason envelope of the collection, without *key*
+    : param str key: name of the item list in the envelope
+    : param query: query for the rows, including the ordering
+    : param serialize: function returning the item of a row
+    : param str stream: "mason" or "ndjson", see stream_format
+    """
+
+    def batches():
+        # The session of the view was removed when its context was torn
+        # down, run the query in the session of the streaming context so
+        # that its connection is returned at the end
+        rows = iter(query.with_session(db.session()).yield_per(STREAM_BATCH_SIZE))
+        while True:
+            batch = list(islice(rows, STREAM_BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+    def generate_ndjson():
+        for batch in batches():
+            yield "".join(json.dumps(serialize(row)) + "\n" for row in batch)
+
+    def generate_mason():
+        head = json.dumps(body)
+        yield "{}{}{}: [".format(head[:-1], ", " if body else "", json.dumps(key))
+        separator = ""
+        for batch in batches():
+            yield separator + ", ".join(json.dumps(serialize(row)) for row in batch)
+            separator = ", "
+        yield "]}"
+
+    if stream == "ndjson":
+        return Response(stream_with_context(generate_ndjson()), 200, mimetype=NDJSON)
+    return Response(stream_with_context(generate_mason()), 200, mimetype=MASON)
+
+def cached_response(group):
+    """
+    Decorator for resource GET methods that caches the response by URL. Cached
+    responses are grouped so that a write can invalidate every URL of the
+    resources it touched, including all their query string variants, by
+    bumping the generation of the group.
+
+    : param str group: name of the cache group, formatted with the view
+        arguments, e.g. "movie:{movie.name}"
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, **kwargs):
+            # The generation must be read before the response is built so
+            # that a write committed meanwhile can't leave stale data behind
+            key = "view/{}/{}/{}".format(
+                _cache_generation(group.format(**kwargs)),
+                read_source(),
+                request.full_path
+            )
+            hit = cache.get(key)
+            count_cache_lookup(hit is not None)
+            if hit is not None:
+                data, status, headers = hit
+                return Response(data, status, headers=headers)
+
+            resp = func(self, **kwargs)
+            if resp.status_code == 200 and not resp.is_streamed:
+                cache.set(key, (resp.get_data(), resp.status_code, list(resp.headers.items())))
+            return resp
+        return wrapper
+    return decorator
+
+def conditional_response(stamp):
+    """
+    Decorator for resource GET methods that adds a strong ETag and a
+    Last-Modified header to the response. If the client already has the
+    current representation a 304 response is returned without running the
+    method at all, so the stamp must be cheap to compute.
+
+    : param stamp: function receiving the view arguments and returning a
+        tuple (version string, last modified datetime or None), see
+        table_stamp and row_stamp
+    """
 
-def add_person(PersonObject, name):
-    person = PersonObject(
-        name=name
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, **kwargs):
+            version, last_modified = stamp(**kwargs)
+            etag = hashlib.sha1(
+                "{} {}".format(version, request.full_path).encode("utf-8")
+            ).hexdigest()
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            elif request.if_modified_since and last_modified:
+                not_modified = last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+            else:
+                not_modified = False
+
+            if not_modified:
+                resp = Response(status=304)
+            else:
+                resp = func(self, **kwargs)
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            if last_modified:
+                resp.last_modified = last_modified
+            return resp
+        return wrapper
+    return decorator
+
+def table_stamp(*tables):
+    """
+    Returns the combined version stamp of the given tables for
+    conditional_response.
+    """
+
+    versions = {row.name: row for row in TableVersion.query.filter(TableVersion.name.in_(tables))}
+    version = ".".join(
+        "{}-{}".format(table, versions[table].version if table in versions else 0)
+        for table in tables
+    )
+    modified = [row.updated_at for row in versions.values()]
+    return version, max(modified) if modified else None
+
+def row_stamp(obj):
+    """
+    Returns the version stamp of a single Movie or Review row for
+    conditional_response.
+    """
+
+    return "{}-{}-{}".format(obj.__tablename__, obj.id, obj.version), obj.updated_at
+
+def invalidate_cache(*groups):
+    """
+    Marks cache groups to be invalidated when the current transaction is
+    committed. Writes done through the ORM are tracked automatically, this is
+    needed only for statements that bypass the unit of work.
+    """
+
+    db.session.info.setdefault("cache_groups", set()).update(groups)
+
+def bump_cache_groups(*groups):
+    """
+    Invalidates cache groups right away. For writes that don't go through
+    the session at all, like the bulk import, see invalidate_cache.
+    """
+
+    for group in groups:
+        _cache_generation(group, bump=True)
+
+def _cache_generation(group, bump=False):
+    key = "gen/" + group
+    generation = None if bump else cache.get(key)
+    if generation is None:
+        # A fresh random token is used instead of a counter so that an
+        # evicted generation can never bring old entries back to life
+        generation = uuid.uuid4().hex
+        cache.set(key, generation, timeout=0)
+    return "{}/{}".format(group, generation)
+
+def _cache_groups(obj):
+    if isinstance(obj, Movie):
+        names = {obj.name}
+        names.update(inspect(obj).attrs.name.history.deleted)
+        groups = {"movies", "actors", "directors", "writers", "search"}
+        for name in names:
+            groups.add("movie:{}".format(name))
+            groups.add("reviews:{}".format(name))
+        return groups
+    if isinstance(obj, Review):
+        names = {obj.movie.name if obj.movie is not None else obj.movie_name}
+        names.update(inspect(obj).attrs.movie_name.history.deleted)
+        # The movie item includes the review statistics
+        groups = {
+            group.format(name)
+            for name in names
+            for group in ("reviews:{}", "movie:{}")
+        }
+        groups.add("search")
+        return groups
+    if isinstance(obj, (Actor, Director, Writer)):
+        return {obj.__tablename__ + "s"}
+    return set()
+
+def resolve_persons(PersonObject, names):
+    """
+    Gets or creates persons by name in a fixed number of statements: one
+    INSERT ... ON CONFLICT DO NOTHING for all the names and one IN query to
+    load them. Names inserted concurrently by another worker are simply
+    skipped by the insert, so this never fails on duplicates.
+
+    : param PersonObject: Actor, Director or Writer
+    : param names: iterable of person names
+    : return: dictionary mapping each name to its person object
+    """
+
+    names = set(names)
+    if not names:
+        return {}
+
+    # Pending changes must not be flushed before the new persons are linked
+    # to their movies, otherwise they would be cleaned up as orphans
+    with db.session.no_autoflush:
+        stmt = insert(PersonObject.__table__).on_conflict_do_nothing(index_elements=["name"])
+        result = db.session.execute(stmt, [{"name": name} for name in names])
+        if result.rowcount > 0:
+            invalidate_cache(PersonObject.__tablename__ + "s")
+        return {
+            person.name: person
+            for person in PersonObject.query.filter(PersonObject.name.in_(names))
+        }
+
+def resolve_credits(PersonObject, names):
+    """
+    Same as resolve_persons but returns a list of persons in the order of
+    *names*, without duplicates.
+    """
+
+    persons = resolve_persons(PersonObject, names)
+    return [persons[name] for name in dict.fromkeys(names)]
+
+def iter_json_items(stream, ndjson=False):
+    """
+    Parses a JSON array or newline delimited JSON incrementally from a binary
+    stream, so that only a small part of a large request body is held in
+    memory at a time.
+
+    Yields a tuple (item, error) for every element, where error is None or a
+    string describing why the element couldn't be parsed. A syntax error in a
+    JSON array ends the iteration since the rest of the array can't be
+    located, and so does anything but whitespace after the array.
+
+    : param stream: binary file-like object, e.g. request.stream
+    : param bool ndjson: parse one document per line instead of an array
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read():
+        chunk = stream.read(BULK_READ_SIZE)
+        return decoder.decode(chunk, final=not chunk), not chunk
+
+    if ndjson:
+        buf, eof = "", False
+        while not eof:
+            chunk, eof = read()
+            buf += chunk
+            *lines, buf = buf.split("\n")
+            if eof:
+                lines.append(buf)
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line), None
+                except ValueError as e:
+                    yield None, "Invalid JSON: {}".format(e)
+        return
+
+    parser = json.JSONDecoder()
+    buf, eof, pos = "", False, 0
+    expect = "["
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        # A value needs at least one character after it before it can be
+        # trusted, otherwise a number split between reads is cut short
+        if len(buf) - pos < 2 and not eof:
+            chunk, eof = read()
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        if pos == len(buf):
+            if expect != "end":
+                yield None, "Invalid JSON: unexpected end of data"
+            return
+
+        char = buf[pos]
+        if expect == "[":
+            if char != "[":
+                yield None, "Invalid JSON: request body must be an array"
+                return
+            pos += 1
+            expect = "value or ]"
+        elif expect in (", or ]", "value or ]") and char == "]":
+            pos += 1
+            expect = "end"
+        elif expect == "end":
+            yield None, "Invalid JSON: unexpected data after the array"
+            return
+        elif expect == ", or ]":
+            if char != ",":
+                yield None, "Invalid JSON: expected , or ] between array items"
+                return
+            pos += 1
+            expect = "value"
+        else:
+            try:
+                item, end = parser.raw_decode(buf, pos)
+                if end == len(buf) and not eof:
+                    raise ValueError("value may continue in the next read")
+            except ValueError as e:
+                if eof:
+                    yield None, "Invalid JSON: {}".format(e)
+                    return
+                chunk, eof = read()
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item, None
+            pos = end
+            expect = ", or ]"
+
+def delete_orphans(PersonObject, ids=None, connection=None):
+    """
+    Deletes persons that are not credited in any movie with a single DELETE
+    statement. Without *ids* every person of the type is checked, which is
+    meant for periodic full sweeps only.
+
+    : param PersonObject: Actor, Director or Writer
+    : param ids: ids of the persons to check, None to check all
+    : param connection: connection to use, defaults to the session's
+    : return: list of the deleted persons' ids
+    """
+
+    if ids is not None and not ids:
+        return []
+    if connection is None:
+        connection = db.session.connection()
+
+    table = PersonObject.__table__
+    secondary = PersonObject.movies.property.secondary
+    stmt = delete(table).where(
+        ~exists().where(secondary.c[PersonObject.__tablename__ + "_id"] == table.c.id)
+    )
+    if ids is not None:
+        stmt = stmt.where(table.c.id.in_(ids))
+
+    deleted = connection.execute(stmt.returning(table.c.id)).scalars().all()
+    if deleted:
+        invalidate_cache(PersonObject.__tablename__ + "s")
+        bump_table_versions(connection, [PersonObject.__tablename__])
+    return deleted
+
+def _score_aggregate(aggregate):
+    movie = Movie.__table__
+    review = Review.__table__
+    return select(aggregate(review.c.score)).where(
+        review.c.movie_name == movie.c.name
+    ).scalar_subquery()
+
+def update_review_stats(connection, movie_name, added, removed):
+    """
+    Applies review changes to the statistics of one movie. Count and sum are
+    updated from the given scores alone. The minimum and maximum can't be
+    undone incrementally, so they are recomputed from the movie's reviews
+    only when a removed score was at the current bound.
+
+    : param connection: connection to use, the reviews must already be flushed
+    : param str movie_name: name of the movie
+    : param list added: scores of the reviews added to the movie
+    : param list removed: scores of the reviews removed from the movie
+    """
+
+    movie = Movie.__table__
+    values = {
+        "review_count": movie.c.review_count + len(added) - len(removed),
+        "score_sum": movie.c.score_sum + sum(added) - sum(removed),
+        "version": movie.c.version + 1,
+        "updated_at": utcnow()
+    }
+    for column, aggregate, pick, beyond in (
+            (movie.c.score_min, func.min, min, lambda bound, score: bound >= score),
+            (movie.c.score_max, func.max, max, lambda bound, score: bound <= score)):
+        value = column
+        if added:
+            value = func.coalesce(aggregate(column, pick(added)), pick(added))
+        if removed:
+            value = case(
+                (or_(column.is_(None), beyond(column, pick(removed))), _score_aggregate(aggregate)),
+                else_=value
+            )
+        values[column.key] = value
+
+    connection.execute(update(movie).where(movie.c.name == movie_name).values(values))
+
+def rebuild_review_stats(connection):
+    """
+    Recomputes the review statistics of all movies from scratch.
+    """
+
+    movie = Movie.__table__
+    connection.execute(update(movie).values(
+        review_count=_score_aggregate(func.count),
+        score_sum=func.coalesce(_score_aggregate(func.sum), 0.0),
+        score_min=_score_aggregate(func.min),
+        score_max=_score_aggregate(func.max),
+        version=movie.c.version + 1,
+        updated_at=utcnow()
+    ))
+    invalidate_cache("movies")
+    for name in connection.execute(select(movie.c.name)).scalars():
+        invalidate_cache("movie:{}".format(name))
+
+def bump_table_versions(connection, tables):
+    """
+    Bumps the version stamps of the given tables, see table_stamp.
+    """
+
+    now = utcnow()
+    stmt = insert(TableVersion.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"version": stmt.table.c.version + 1, "updated_at": now}
+    )
+    connection.execute(
+        stmt,
+        [{"name": table, "version": 1, "updated_at": now} for table in sorted(tables)]
     )
-    db.session.add(person)
-    return person
-
-def delete_orphans(PersonObject):
-    orphans = PersonObject.query.filter(~PersonObject.movies.any()).all()
-    
-    for orphan in orphans:
-        db.session.delete(orphan)
+
+@event.listens_for(db.session, 'before_flush')
+def collect_cache_groups(session, flush_context, instances):
+    groups = session.info.setdefault("cache_groups", set())
+    for obj in session.new | session.dirty | session.deleted:
+        groups.update(_cache_groups(obj))
     return
 
-@event.listens_for(Movie, 'after_delete')
-def cleanup_personnel_after_delete(mapper, connection, target):
-    delete_orphans(Actor)
-    delete_orphans(Director)
-    delete_orphans(Writer)
+@event.listens_for(db.session, 'before_flush')
+def bump_row_versions(session, flush_context, instances):
+    now = utcnow()
+    for obj in session.dirty:
+        if isinstance(obj, (Movie, Review)) and session.is_modified(obj):
+            obj.version = obj.version + 1
+            obj.updated_at = now
+
+    tables = session.info.setdefault("touched_tables", set())
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, TableVersion):
+            tables.add(obj.__tablename__)
     return
 
 @event.listens_for(db.session, 'after_flush')
-def cleanup_personnel_after_update(session, flush_context):
+def stamp_touched_tables(session, flush_context):
+    tables = session.info.pop("touched_tables", ())
+    if tables:
+        bump_table_versions(session.connection(), tables)
+    return
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cache_groups(session):
+    for group in session.info.pop("cache_groups", ()):
+        _cache_generation(group, bump=True)
+    return
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_cache_groups(session):
+    session.info.pop("cache_groups", None)
+    session.info.pop("touched_tables", None)
+    session.info.pop("orphan_candidates", None)
+    session.info.pop("review_stats", None)
+    return
+
+@event.listens_for(db.session, 'before_flush')
+def collect_orphan_candidates(session, flush_context, instances):
+    # Only persons that lose a credit in this flush can become orphans
+    candidates = session.info.setdefault("orphan_candidates", {})
     for obj in session.dirty:
         if isinstance(obj, Movie):
-            delete_orphans(Actor)
-            delete_orphans(Director)
-            delete_orphans(Writer)
+            state = inspect(obj)
+            for PersonObject in (Actor, Director, Writer):
+                removed = state.attrs[PersonObject.__tablename__ + "s"].history.deleted
+                candidates.setdefault(PersonObject, set()).update(
+                    person.id for person in removed if person.id is not None
+                )
+        elif isinstance(obj, (Actor, Director, Writer)):
+            if inspect(obj).attrs.movies.history.deleted:
+                candidates.setdefault(type(obj), set()).add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Movie):
+            for PersonObject in (Actor, Director, Writer):
+                credits = getattr(obj, PersonObject.__tablename__ + "s")
+                candidates.setdefault(PersonObject, set()).update(
+                    person.id for person in credits if person.id is not None
+                )
+    return
+
+@event.listens_for(db.session, 'after_flush')
+def cleanup_personnel_after_update(session, flush_context):
+    candidates = session.info.pop("orphan_candidates", {})
+    connection = session.connection()
+    for PersonObject, ids in candidates.items():
+        ids.difference_update(
+            obj.id for obj in session.deleted if isinstance(obj, PersonObject)
+        )
+        deleted = delete_orphans(PersonObject, ids, connection)
+        if deleted:
+            session.info.setdefault("deleted_orphans", []).append((PersonObject, deleted))
     return
 
+@event.listens_for(db.session, 'after_flush_postexec')
+def expunge_deleted_orphans(session, flush_context):
+    # Orphans were deleted with a plain DELETE, drop them from the identity
+    # map too so that they aren't refreshed or flushed later
+    for PersonObject, ids in session.info.pop("deleted_orphans", ()):
+        for id in ids:
+            person = session.identity_map.get(identity_key(PersonObject, id))
+            if person is not None and inspect(person).persistent:
+                session.expunge(person)
+    return
+
+def _committed_value(obj, attr):
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return history.unchanged[0] if history.unchanged else None
+
+@event.listens_for(db.session, 'before_flush')
+def collect_review_stats(session, flush_context, instances):
+    changes = session.info.setdefault("review_stats", {})
+
+    def change(name, score, index):
+        # Invalid values are left for the database to reject
+        if name is not None and isinstance(score, (int, float)):
+            changes.setdefault(name, ([], []))[index].append(score)
+
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, Review):
+            continue
+        if obj not in session.new:
+            old = (_committed_value(obj, "movie_name"), _committed_value(obj, "score"))
+        else:
+            old = (None, None)
+        if obj not in session.deleted:
+            new = (obj.movie.name if obj.movie is not None else obj.movie_name, obj.score)
+        else:
+            new = (None, None)
+        if old != new:
+            change(*old, 1)
+            change(*new, 0)
+    return
+
+@event.listens_for(db.session, 'after_flush')
+def apply_review_stats(session, flush_context):
+    changes = session.info.pop("review_stats", {})
+    deleted = {obj.name for obj in session.deleted if isinstance(obj, Movie)}
+    connection = session.connection()
+    for name, (added, removed) in changes.items():
+        if name not in deleted:
+            update_review_stats(connection, name, added, removed)
+    session.info["stale_review_stats"] = set(changes) - deleted
+    return
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def expire_review_stats(session, flush_context):
+    names = session.info.pop("stale_review_stats", ())
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, Movie) and obj.name in names:
+            session.expire(obj, [
+                "review_count", "score_sum", "score_min", "score_max", "version", "updated_at"
+            ])
+    return
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import pytest
+import shutil
+import tempfile
+from superkinodb import create_app, db
+from werkzeug.http import parse_date
+from test_resources import _create_test_data, _get_movie_json, _get_review_json
+
+pytest.importorskip("aiosqlite")
+pytest.importorskip("greenlet")
+
+from superkinodb.asgi import create_asgi_app
+
+# Requests made to both apps in this order, the writes in between change the
+# data the later reads see
+REQUESTS = [
+    ("GET", "/api/", None),
+    ("GET", "/api/movies/", None),
+    ("GET", "/api/movies/?limit=2", None),
+    ("GET", "/api/movies/?genre=horror&count=true", None),
+    ("GET", "/api/movies/?stream=ndjson", None),
+    ("GET", "/api/movies/?stream=mason", None),
+    ("GET", "/api/movies/test-movie-1/", None),
+    ("GET", "/api/movies/no-such-movie/", None),
+    ("GET", "/api/movies/test-movie-1/reviews/", None),
+    ("GET", "/api/movies/test-movie-1/reviews/test-reviewer-1/", None),
+    ("GET", "/api/actors/", None),
+    ("GET", "/api/directors/", None),
+    ("GET", "/api/writers/", None),
+    ("GET", "/api/search/?q=test", None),
+    ("POST", "/api/movies/", _get_movie_json()),
+    ("POST", "/api/movies/", {"name": 1}),
+    ("PUT", "/api/movies/test-movie-2/", _get_movie_json("movie-2")),
+    ("POST", "/api/movies/test-movie/reviews/", _get_review_json()),
+    ("PUT", "/api/movies/test-movie/reviews/test-reviewer/", _get_review_json()),
+    ("DELETE", "/api/movies/test-movie-1/reviews/test-reviewer-2/", None),
+    ("DELETE", "/api/movies/test-movie-3/", None),
+    ("POST", "/api/movies-bulk/", [_get_movie_json("bulk-1"), _get_movie_json("bulk-2")]),
+    ("PUT", "/api/actors/", None),
+    ("GET", "/api/movies/", None),
+    ("GET", "/api/movies/test-movie/", None),
+    ("GET", "/api/movies/test-movie/reviews/", None),
+    ("GET", "/api/movies/test-movie-1/reviews/", None),
+    ("GET", "/api/actors/", None),
+]
+
+@pytest.fixture
+def apps():
+    """
+    Creates the WSGI app and the ASGI app on two copies of the same test
+    database.
+    """
+
+    fnames = []
+    for i in range(2):
+        db_fd, db_fname = tempfile.mkstemp()
+        os.close(db_fd)
+        fnames.append(db_fname)
+    config = {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + fnames[0], "TESTING": True}
+
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        _create_test_data()
+        db.engine.dispose()
+    shutil.copyfile(fnames[0], fnames[1])
+
+    asgi_app = create_asgi_app(dict(config, SQLALCHEMY_DATABASE_URI="sqlite:///" + fnames[1]))
+    yield app, asgi_app
+
+    with app.app_context():
+        db.engine.dispose()
+    asyncio.run(_lifespan_shutdown(asgi_app))
+    for fname in fnames:
+        os.unlink(fname)
+
+async def _lifespan_shutdown(asgi_app):
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    await asgi_app({"type": "lifespan"}, receive, send)
+
+async def _asgi_request(asgi_app, method, url, body=None, content_type="application/json",
+                        chunk_size=None, received_chunks=None):
+    path, _, query = url.partition("?")
+    headers = [(b"host", b"localhost")]
+    data = b""
+    if body is not None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        headers += [(b"content-type", content_type.encode()), (b"content-length", str(len(data)).encode())]
+    chunk_size = chunk_size or len(data) or 1
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [b""]
+    if received_chunks is None:
+        received_chunks = []
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query.encode("latin-1"),
+        "headers": headers,
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+    received = []
+
+    async def receive():
+        chunk = chunks[len(received_chunks)]
+        received_chunks.append(chunk)
+        return {"type": "http.request", "body": chunk, "more_body": len(received_chunks) < len(chunks)}
+
+    async def send(message):
+        received.append(message)
+
+    await asgi_app(scope, receive, send)
+    start = received[0]
+    assert start["type"] == "http.response.start"
+    response_headers = {
+        name.decode("latin-1").lower(): value.decode("latin-1") for name, value in start["headers"]
+    }
+    return start["status"], response_headers, b"".join(m.get("body", b"") for m in received[1:])
+
+def test_parity(apps):
+    """
+    Tests that the ASGI app gives the same responses as the WSGI app.
+    """
+
+    app, asgi_app = apps
+    client = app.test_client()
+    for method, url, body in REQUESTS:
+        resp = client.open(url, method=method, json=body)
+        status, headers, data = asyncio.run(_asgi_request(asgi_app, method, url, body))
+        assert status == resp.status_code, (method, url)
+        assert headers.get("content-type") == resp.headers.get("Content-Type"), (method, url)
+        assert headers.get("location") == resp.headers.get("Location"), (method, url)
+        assert headers.get("allow") == resp.headers.get("Allow"), (method, url)
+        assert headers.get("x-total-count") == resp.headers.get("X-Total-Count"), (method, url)
+        assert headers.get("etag") == resp.headers.get("ETag"), (method, url)
+        # Stamped with the time of the writes, which were made a moment
+        # apart in the two apps
+        if resp.last_modified is None:
+            assert "last-modified" not in headers, (method, url)
+        else:
+            last_modified = parse_date(headers["last-modified"])
+            assert abs((last_modified - resp.last_modified).total_seconds()) <= 1, (method, url)
+        assert data == resp.data, (method, url)
+
+def test_streamed_body(apps):
+    """
+    Tests that the request body is passed to the app as it reads it.
+    """
+
+    app, asgi_app = apps
+    lines = [json.dumps(_get_movie_json("bulk-{}".format(i))) for i in range(20)]
+    data = "\n".join(lines).encode("utf-8")
+    chunks = []
+    status, headers, body = asyncio.run(_asgi_request(
+        asgi_app, "POST", "/api/movies-bulk/", data, "application/x-ndjson", 16, chunks
+    ))
+    assert status == 200
+    assert json.loads(body)["created"] == 20
+    assert b"".join(chunks) == data
+
+    # A body the app doesn't read isn't received either
+    chunks = []
+    status, headers, body = asyncio.run(_asgi_request(
+        asgi_app, "POST", "/api/movies-bulk/", data, "text/plain", 16, chunks
+    ))
+    assert status == 415
+    assert len(chunks) < len(data) / 16
+
+def test_concurrent(apps):
+    """
+    Tests that concurrent requests are served by the same process and event
+    loop without mixing up their responses.
+    """
+
+    app, asgi_app = apps
+    client = app.test_client()
+    urls = ["/api/movies/test-movie-{}/".format(i) for i in range(1, 5)] * 10
+    urls += ["/api/movies/test-movie-{}/reviews/".format(i) for i in range(1, 5)] * 10
+    expected = {url: client.get(url).data for url in set(urls)}
+
+    async def run():
+        return await asyncio.gather(*[_asgi_request(asgi_app, "GET", url) for url in urls])
+
+    for url, (status, headers, data) in zip(urls, asyncio.run(run())):
+        assert status == 200
+        assert data == expected[url]
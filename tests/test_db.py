@@ -1,3 +1,6 @@
+import csv
+import gzip
+import json
 import os
 import pytest
 import random
@@ -5,10 +8,12 @@ import string
 import tempfile
 from datetime import date
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, inspect, text
 from sqlalchemy.exc import IntegrityError, NoResultFound, StatementError
 from superkinodb import create_app, db
 from superkinodb.db_models import Movie, Review, Actor, Writer, Director
+from superkinodb.dataio import generate_documents, iter_movie_documents, read_snapshot
+from superkinodb.utils import resolve_persons
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -31,6 +36,8 @@ def app():
 
     yield app
 
+    with app.app_context():
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -311,3 +318,324 @@ def test_person_columns(app):
             db.session.commit()
 
         db.session.rollback()
+
+def test_person_orphan_cleanup(app):
+    with app.app_context():
+        movie = _create_movie()
+        actor1 = _create_person(Actor, "test-Actor1")
+        actor2 = _create_person(Actor, "test-Actor2")
+        director = _create_person(Director, "test-Director")
+        movie.actors.append(actor1)
+        movie.actors.append(actor2)
+        movie.directors.append(director)
+        db.session.add(movie)
+        db.session.add(_create_person(Writer, "test-Uncredited"))
+        db.session.commit()
+
+        # Only the person that lost its credit is deleted
+        movie.actors.remove(actor1)
+        movie.genre = "drama"
+        db.session.commit()
+        assert [a.name for a in Actor.query.all()] == ["test-Actor2"]
+        assert Writer.query.count() == 1
+
+        db.session.delete(movie)
+        db.session.commit()
+        assert Actor.query.count() == 0
+        assert Director.query.count() == 0
+        assert Writer.query.count() == 1
+
+    result = app.test_cli_runner().invoke(args=["cleanup-people"])
+    assert "Deleted 1 orphaned writers" in result.output
+    with app.app_context():
+        assert Writer.query.count() == 0
+
+def test_resolve_persons(app):
+    with app.app_context():
+        db.session.add(_create_person(Actor, "test-Actor1"))
+        db.session.commit()
+
+        # Only persons that are created invalidate the cached listings
+        persons = resolve_persons(Actor, ["test-Actor1"])
+        assert list(persons) == ["test-Actor1"]
+        assert "actors" not in db.session.info.get("cache_groups", ())
+        persons = resolve_persons(Actor, ["test-Actor1", "test-Actor2", "test-Actor2"])
+        assert sorted(persons) == ["test-Actor1", "test-Actor2"]
+        assert "actors" in db.session.info["cache_groups"]
+        db.session.rollback()
+
+def test_create_indexes(app):
+    with app.app_context():
+        # Simulate a database created before the indexes were added
+        db.session.execute(text("DROP INDEX ix_review_reviewer"))
+        db.session.execute(text("DROP TABLE movie_actors"))
+        db.session.execute(text(
+            "CREATE TABLE movie_actors (movie_id INTEGER, actor_id INTEGER)"
+        ))
+        db.session.execute(text("INSERT INTO movie_actors VALUES (1, 1), (1, 1), (1, 2)"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["create-indexes"])
+    assert result.exit_code == 0
+    assert "Created ix_review_reviewer" in result.output
+    assert "Created uq_movie_actors_pk" in result.output
+    assert "Created ix_movie_actors_actor_id" in result.output
+
+    with app.app_context():
+        indexes = {ix["name"] for ix in inspect(db.engine).get_indexes("movie_actors")}
+        assert indexes == {"uq_movie_actors_pk", "ix_movie_actors_actor_id"}
+        rows = db.session.execute(text("SELECT count(*) FROM movie_actors")).scalar()
+        assert rows == 2
+
+    # Nothing left to do on the second run
+    result = app.test_cli_runner().invoke(args=["create-indexes"])
+    assert "Created" not in result.output
+
+# Schema of the first version of the database
+OLD_SCHEMA = [
+    "CREATE TABLE director (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE writer (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE actor (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE movie (id INTEGER NOT NULL, name VARCHAR NOT NULL, release DATE, "
+    "genre VARCHAR, PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE review (id INTEGER NOT NULL, reviewer VARCHAR NOT NULL, "
+    "review_text VARCHAR(1000), score FLOAT NOT NULL, movie_name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id), CONSTRAINT unique_movie_review UNIQUE (movie_name, reviewer), "
+    "FOREIGN KEY(movie_name) REFERENCES movie (name) ON DELETE CASCADE)",
+    "CREATE TABLE movie_actors (movie_id INTEGER, actor_id INTEGER, "
+    "FOREIGN KEY(movie_id) REFERENCES movie (id), FOREIGN KEY(actor_id) REFERENCES actor (id))",
+    "CREATE TABLE movie_directors (movie_id INTEGER, director_id INTEGER, "
+    "FOREIGN KEY(movie_id) REFERENCES movie (id), FOREIGN KEY(director_id) REFERENCES director (id))",
+    "CREATE TABLE movie_writers (movie_id INTEGER, writer_id INTEGER, "
+    "FOREIGN KEY(movie_id) REFERENCES movie (id), FOREIGN KEY(writer_id) REFERENCES writer (id))",
+    "INSERT INTO movie VALUES (1, 'test-movie', '2020-01-01', 'comedy')",
+    "INSERT INTO review VALUES (1, 'test-reviewer-1', 'good', 8.0, 'test-movie')",
+    "INSERT INTO review VALUES (2, 'test-reviewer-2', 'bad', 2.0, 'test-movie')",
+]
+
+@pytest.fixture
+def old_app(app):
+    with app.app_context():
+        db.drop_all()
+        for statement in OLD_SCHEMA:
+            db.session.execute(text(statement))
+        db.session.commit()
+    return app
+
+def test_upgrade_db(old_app):
+    result = old_app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+    assert "Created table_version" in result.output
+    assert "Added movie.version" in result.output
+    assert "Added review.updated_at" in result.output
+    assert "Added movie.review_count" in result.output
+    assert "Rebuilt review statistics" in result.output
+    assert "Rebuilt review\n" in result.output
+
+    with old_app.app_context():
+        inspector = inspect(db.engine)
+        for table in ("movie", "review"):
+            columns = {column["name"] for column in inspector.get_columns(table)}
+            assert {"version", "updated_at"} <= columns
+        rows = db.session.execute(text("SELECT version, updated_at FROM review")).all()
+        assert len(rows) == 2
+        assert all(version == 1 and updated_at for version, updated_at in rows)
+        foreign_keys = inspector.get_foreign_keys("review")
+        assert foreign_keys[0]["options"]["onupdate"] == "CASCADE"
+        indexes = {index["name"] for index in inspector.get_indexes("review")}
+        assert "ix_review_reviewer" in indexes
+
+    client = old_app.test_client()
+    assert client.get("/api/movies/").status_code == 200
+    resp = client.get("/api/movies/test-movie/")
+    assert resp.status_code == 200
+    assert resp.json["data"]["reviews"] == {
+        "count": 2, "score_mean": 5.0, "score_min": 2.0, "score_max": 8.0
+    }
+    resp = client.put("/api/movies/test-movie/", json={"name": "test-renamed"})
+    assert resp.status_code == 204
+    resp = client.get("/api/movies/test-renamed/reviews/")
+    assert len(resp.json["reviews"]) == 2
+
+    # Nothing left to do on the second run
+    result = old_app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+    assert result.output == ""
+
+def test_rebuild_search(app):
+    with app.app_context():
+        # Simulate a database created before the search index was added
+        db.session.execute(text("DROP TABLE movie_fts"))
+        db.session.execute(text("DROP TRIGGER movie_fts_ai"))
+        db.session.add(_create_movie())
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["rebuild-search"])
+    assert result.exit_code == 0
+    assert "Rebuilt movie_fts" in result.output
+
+    with app.app_context():
+        rows = db.session.execute(text(
+            "SELECT rowid FROM movie_fts WHERE movie_fts MATCH 'comedy'"
+        )).all()
+        assert len(rows) == 1
+
+def test_sqlite_pragmas(app, caplog):
+    """
+    Tests that every connection gets the configured SQLite settings and that
+    the startup check reports settings SQLite didn't accept.
+    """
+
+    with app.app_context():
+        connection = db.session.connection()
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert connection.exec_driver_sql("PRAGMA temp_store").scalar() == 2
+        assert connection.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+        assert db.engine.pool.size() == 10
+
+    # WAL isn't available for in-memory databases, which don't take the
+    # pool options either
+    create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "TESTING": True
+    })
+    warnings = [r.getMessage() for r in caplog.records if r.name == "superkinodb.sqlite"]
+    assert "SQLite journal_mode is memory instead of wal" in warnings
+
+def test_export(app, tmp_path):
+    with app.app_context():
+        movie = _create_movie()
+        movie.actors.append(_create_person(Actor, "test-Actor2"))
+        movie.actors.append(_create_person(Actor, "test-Actor1"))
+        movie.reviews.append(_create_review())
+        other = _create_movie("Good Movie 2")
+        other.release = None
+        db.session.add(movie)
+        db.session.add(other)
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["export", str(tmp_path / "movies.jsonl")])
+    assert result.exit_code == 0
+    assert "Exported 2 movies" in result.output
+    with open(tmp_path / "movies.jsonl", encoding="utf-8") as f:
+        documents = [json.loads(line) for line in f]
+    assert [d["name"] for d in documents] == ["test-Good Movie 1", "test-Good Movie 2"]
+    assert documents[0]["actors"] == ["test-Actor1", "test-Actor2"]
+    assert documents[0]["reviews"][0]["reviewer"] == "test-VeryCriticalGuy69"
+    assert "release" not in documents[1]
+
+    result = runner.invoke(args=["export", str(tmp_path / "movies.csv.gz"), "--batch-size", "1"])
+    assert result.exit_code == 0
+    with gzip.open(tmp_path / "movies.csv.gz", "rt", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [r["name"] for r in rows] == [d["name"] for d in documents]
+    assert json.loads(rows[0]["reviews"]) == documents[0]["reviews"]
+    assert rows[1]["release"] == ""
+
+def test_export_snapshot(app):
+    with app.app_context():
+        db.session.add(_create_movie("Good Movie 1"))
+        db.session.add(_create_movie("Good Movie 2"))
+        db.session.commit()
+
+        for i, journal_mode in enumerate(("delete", "wal")):
+            db.session.execute(text("PRAGMA journal_mode={}".format(journal_mode)))
+            with read_snapshot(db.engine) as connection:
+                documents = iter_movie_documents(connection, batch_size=1)
+                names = [next(documents)["name"]]
+
+                # Writers aren't blocked and the export doesn't see them
+                db.session.add(_create_movie("Good Movie 3-{}".format(i)))
+                db.session.commit()
+                names += [d["name"] for d in documents]
+            assert names == ["test-Good Movie {}".format(n) for n in (1, 2)] + [
+                "test-Good Movie 3-{}".format(n) for n in range(i)
+            ]
+
+def test_import(app, tmp_path):
+    documents = [
+        {
+            "name": "test-a",
+            "release": "2001-02-03",
+            "genre": "drama",
+            "actors": ["test-x", "test-y", "test-x"],
+            "directors": ["test-d"],
+            "reviews": [
+                {"reviewer": "test-r1", "score": 4.0, "review_text": "fine"},
+                {"reviewer": "test-r2", "score": 8.0}
+            ]
+        },
+        {"name": "test-b", "actors": ["test-y"]},
+        {"name": "test-bad", "release": "not a date"},
+        {"name": "test-a"},
+    ]
+    with open(tmp_path / "movies.jsonl", "w", encoding="utf-8") as f:
+        for document in documents:
+            f.write(json.dumps(document) + "\n")
+        f.write("{not json\n")
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=[
+        "import", str(tmp_path / "movies.jsonl"),
+        "--workers", "2", "--batch-size", "2", "--drop-indexes"
+    ])
+    assert result.exit_code == 0
+    assert "Imported 2 movies and 2 reviews" in result.output
+    assert "3 failed" in result.output
+    with app.app_context():
+        movie = Movie.query.filter_by(name="test-a").one()
+        assert sorted(a.name for a in movie.actors) == ["test-x", "test-y"]
+        assert (movie.review_count, movie.score_sum, movie.score_min) == (2, 12.0, 4.0)
+        assert Actor.query.count() == 2
+        indexes = {ix["name"] for ix in inspect(db.engine).get_indexes("review")}
+        assert "ix_review_reviewer" in indexes
+        rows = db.session.execute(text(
+            "SELECT rowid FROM movie_fts WHERE movie_fts MATCH 'drama'"
+        )).all()
+        assert len(rows) == 1
+
+    # A movie imported without a release date gets today's date
+    client = app.test_client()
+    response = client.get("/api/movies/test-b/")
+    assert response.status_code == 200
+    assert response.json["data"]["release"] == date.today().isoformat()
+    response = client.get("/api/movies-bulk/?name=test-b")
+    assert response.json["results"][0]["status"] == 200
+
+    # Exporting, emptying the database and importing gives the same data
+    runner.invoke(args=["export", str(tmp_path / "before.jsonl")])
+    runner.invoke(args=["export", str(tmp_path / "movies.csv.gz")])
+    with app.app_context():
+        for movie in Movie.query.all():
+            db.session.delete(movie)
+        db.session.commit()
+    result = runner.invoke(args=["import", str(tmp_path / "movies.csv.gz"), "--workers", "1"])
+    assert "Imported 2 movies" in result.output
+    runner.invoke(args=["export", str(tmp_path / "after.jsonl")])
+    with open(tmp_path / "before.jsonl") as before, open(tmp_path / "after.jsonl") as after:
+        assert before.read() == after.read()
+
+def test_testgen(app):
+    args = ["testgen", "--movies", "50", "--people", "40", "--reviews", "300", "--seed", "1"]
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=args)
+    assert result.exit_code == 0
+    assert "Generated 50 movies and 300 reviews" in result.output
+    with app.app_context():
+        assert Movie.query.count() == 50
+        assert Review.query.count() == 300
+        assert Actor.query.count() + Director.query.count() + Writer.query.count() <= 40
+        # Popular movies get a large share of the reviews
+        counts = sorted((movie.review_count for movie in Movie.query), reverse=True)
+        assert counts[0] > 3 * 300 / 50
+
+    # The same seed generates the same movies, which are skipped
+    result = runner.invoke(args=args)
+    assert "Skipped 50 movies that already exist" in result.output
+    assert list(generate_documents(20, 30, 100, seed=2)) == list(generate_documents(20, 30, 100, seed=2))
@@ -2,14 +2,21 @@ import json
 import os
 import pytest
 import random
+import shutil
+import sqlite3
 import string
 import tempfile
+import threading
 from datetime import date
+from types import SimpleNamespace
+from flask import url_for
 from jsonschema import validate
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy import event, text
 from superkinodb import create_app, db
 from superkinodb.db_models import Movie, Review, Actor, Writer, Director
+from superkinodb.metrics import Registry
+from superkinodb.utils import SuperkinodbBuilder, url_template
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
@@ -32,10 +39,46 @@ def client():
         _create_test_data()
         
     yield app.test_client()
-    
+
+    with app.app_context():
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
+@pytest.fixture
+def make_app():
+    """
+    Returns a factory of apps on new test databases with the test data. The
+    keyword arguments of the factory are added to the test config. The apps
+    and their databases are cleaned up when the test ends.
+    """
+
+    db_dir = tempfile.mkdtemp()
+    apps = []
+
+    def make_app(**config):
+        app = create_app(dict(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(db_dir, "{}.db".format(len(apps))),
+                "TESTING": True
+            },
+            **config
+        ))
+        apps.append(app)
+        with app.app_context():
+            db.create_all()
+            _create_test_data()
+        return app
+
+    yield make_app
+
+    for app in apps:
+        with app.app_context():
+            db.engine.dispose()
+        for replica in app.extensions.get("superkinodb.replicas", []):
+            replica.engine.dispose()
+    shutil.rmtree(db_dir)
+
 def _create_test_data():
     for i in range(1, 5):
         m = Movie(
@@ -172,6 +215,112 @@ class TestMovieCollection(object):
         for movie in body["movies"]:
             _check_control_get(client, "self", movie)
 
+    def test_get_paginated(self, client):
+        response = client.get(self.VALID_URL + "?limit=3&count=true")
+        assert response.status_code == 200
+        assert response.headers["X-Total-Count"] == "4"
+        body = json.loads(response.data)
+        assert [m["data"]["name"] for m in body["movies"]] == [
+            "test-movie-1", "test-movie-2", "test-movie-3"
+        ]
+        assert "prev" not in body["@controls"]
+
+        response = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(response.data)
+        assert [m["data"]["name"] for m in body["movies"]] == ["test-movie-4"]
+        assert "next" not in body["@controls"]
+
+        response = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(response.data)
+        assert len(body["movies"]) == 3
+        assert "next" in body["@controls"]
+        assert "prev" not in body["@controls"]
+
+        # Cursors outside the collection, e.g. of a deleted movie, don't link
+        # to empty pages
+        body = json.loads(client.get(self.VALID_URL + "?limit=3&after=a").data)
+        assert body["movies"][0]["data"]["name"] == "test-movie-1"
+        assert "prev" not in body["@controls"]
+        body = json.loads(client.get(self.VALID_URL + "?limit=3&before=z").data)
+        assert body["movies"][-1]["data"]["name"] == "test-movie-4"
+        assert "next" not in body["@controls"]
+
+        response = client.get(self.VALID_URL + "?limit=0")
+        assert response.status_code == 400
+        response = client.get(self.VALID_URL + "?limit=abc")
+        assert response.status_code == 400
+
+    def test_get_streamed(self, client):
+        expected = json.loads(client.get(self.VALID_URL).data)
+
+        response = client.get(self.VALID_URL + "?stream=mason&count=true")
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.headers["X-Total-Count"] == "4"
+        assert json.loads(response.data) == expected
+
+        response = client.get(self.VALID_URL + "?stream=ndjson&genre=horror")
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.data.decode("utf-8").splitlines()
+        assert [json.loads(line) for line in lines] == expected["movies"]
+
+        response = client.get("/api/actors/?stream=mason")
+        assert [a["name"] for a in json.loads(response.data)["actors"]] == [
+            "test-actor-1", "test-actor-2", "test-actor-3", "test-actor-4"
+        ]
+        response = client.get("/api/movies/test-movie-1/reviews/?stream=ndjson")
+        assert len(response.data.splitlines()) == 3
+
+        response = client.get(self.VALID_URL + "?stream=xml")
+        assert response.status_code == 400
+
+    def test_get_filtered(self, client):
+        def names(query):
+            response = client.get(self.VALID_URL + query)
+            assert response.status_code == 200
+            return [m["data"]["name"] for m in json.loads(response.data)["movies"]]
+
+        data = _get_movie_json("old")
+        data["release"] = "2000-01-01"
+        data["actors"] = ["test-actor-1"]
+        data["directors"] = ["test-director-2"]
+        response = client.post(self.VALID_URL, json=data)
+        assert response.status_code == 201
+
+        assert names("?genre=comedy") == ["test-old"]
+        assert len(names("?genre=horror")) == 4
+        assert names("?released_before=2000-12-31") == ["test-old"]
+        assert names("?released_after=2000-01-01&released_before=2000-01-01") == ["test-old"]
+        assert len(names("?released_after=2001-01-01")) == 4
+        assert names("?actor=test-actor-1") == ["test-movie-1", "test-old"]
+        assert names("?actor=test-actor-1&director=test-director-2") == ["test-old"]
+        assert names("?actor=test-actor-1&actor=test-actor-2") == []
+        assert names("?writer=nobody") == []
+
+        response = client.get(self.VALID_URL + "?actor=test-actor-1&limit=1&count=true")
+        assert response.headers["X-Total-Count"] == "2"
+        body = json.loads(response.data)
+        next_href = body["@controls"]["next"]["href"]
+        assert "actor=test-actor-1" in next_href
+        response = client.get(next_href)
+        assert [m["data"]["name"] for m in json.loads(response.data)["movies"]] == ["test-old"]
+
+        # Repeated filters are kept in the links
+        for name in ("both-1", "z-both-2"):
+            data = _get_movie_json(name)
+            data["actors"] = ["test-actor-1", "test-actor-2"]
+            assert client.post(self.VALID_URL, json=data).status_code == 201
+        href = self.VALID_URL + "?actor=test-actor-1&actor=test-actor-2&limit=1"
+        pages = []
+        while href:
+            body = json.loads(client.get(href).data)
+            pages.append([m["data"]["name"] for m in body["movies"]])
+            href = body["@controls"].get("next", {}).get("href")
+        assert pages == [["test-both-1"], ["test-z-both-2"]]
+
+        response = client.get(self.VALID_URL + "?released_after=yesterday")
+        assert response.status_code == 400
+
     def test_post(self, client):
         data = _get_movie_json()
 
@@ -194,6 +343,165 @@ class TestMovieCollection(object):
         response = client.post(self.VALID_URL, json=data)
         assert response.status_code == 400
 
+    def test_post_credits(self, client):
+        data = _get_movie_json()
+        data["actors"] = ["test-actor-new", "test-actor-1", "test-actor-new"]
+        data["directors"] = ["test-director-1"]
+        data["writers"] = ["test-writer-new"]
+
+        response = client.post(self.VALID_URL, json=data)
+        assert response.status_code == 201
+        body = json.loads(client.get(response.headers["Location"]).data)
+        # Credits have no stored position, they're loaded in index order
+        assert sorted(body["data"]["actors"]) == ["test-actor-1", "test-actor-new"]
+        assert body["data"]["directors"] == ["test-director-1"]
+        assert body["data"]["writers"] == ["test-writer-new"]
+
+        response = client.get("/api/actors/?count=true")
+        assert response.headers["X-Total-Count"] == "5"
+        actors = {a["name"]: a["movies"] for a in json.loads(response.data)["actors"]}
+        assert sorted(actors["test-actor-1"]) == sorted(["test-movie-1", data["name"]])
+
+    def test_put(self, client):
+        response = client.put(self.VALID_URL)
+        assert response.status_code == 405
+        assert response.headers["Allow"] == self.VALID_METHODS
+
+    def test_delete(self, client):
+        response = client.delete(self.VALID_URL)
+        assert response.status_code == 405
+        assert response.headers["Allow"] == self.VALID_METHODS
+
+class TestMovieBulk(object):
+    VALID_URL = "/api/movies-bulk/"
+    VALID_METHODS = "GET, POST"
+
+    def test_get(self, client):
+        response = client.get(self.VALID_URL)
+        assert response.status_code == 400
+        response = client.get(self.VALID_URL + "?" + "&".join(["name=a"] * 101))
+        assert response.status_code == 400
+
+        names = ["test-movie-3", "no-such-movie", "test-movie-1", "test-movie-3"]
+        response = client.get(self.VALID_URL, query_string={"name": names})
+        assert response.status_code == 200
+        body = json.loads(response.data)
+        _check_namespace(client, body)
+        _check_control_get(client, "superkinodb:movies", body)
+        assert body["found"] == 3
+        assert body["missing"] == 1
+        assert [r["name"] for r in body["results"]] == names
+        assert [r["status"] for r in body["results"]] == [200, 404, 200, 200]
+        assert "@error" in body["results"][1]
+        for result in (body["results"][0], body["results"][2]):
+            _check_control_get(client, "self", result)
+            item = json.loads(client.get(result["@controls"]["self"]["href"]).data)
+            assert result["data"] == item["data"]
+
+    def test_post(self, client):
+        movies = [_get_movie_json("bulk-{}".format(i)) for i in range(3)]
+        movies[0]["actors"] = ["test-actor-1", "test-actor-new"]
+        movies[1]["actors"] = ["test-actor-new"]
+        movies.append({"name": 5})
+        movies.append(_get_movie_json("bulk-0"))
+        movies.append({"name": "test-movie-1", "actors": ["test-actor-ghost"]})
+
+        response = client.post(self.VALID_URL, data="random")
+        assert response.status_code == 415
+
+        response = client.post(self.VALID_URL, json=movies)
+        assert response.status_code == 200
+        body = json.loads(response.data)
+        assert [r["status"] for r in body["results"]] == [201, 201, 201, 400, 409, 409]
+        assert body["created"] == 3
+        assert body["failed"] == 3
+        for result in body["results"][:3]:
+            _check_control_get(client, "self", result)
+
+        response = client.get("/api/movies/test-bulk-1/")
+        assert json.loads(response.data)["data"]["actors"] == ["test-actor-new"]
+        # The persons of rejected movies are not created
+        response = client.get("/api/actors/?count=true")
+        assert response.headers["X-Total-Count"] == "5"
+        actors = json.loads(response.data)["actors"]
+        assert "test-actor-ghost" not in [actor["name"] for actor in actors]
+
+    def test_post_conflict(self, client):
+        # Stands in for a movie inserted concurrently after the batch
+        # checked for existing movies
+        with client.application.app_context():
+            db.session.execute(text(
+                "CREATE TRIGGER conflict BEFORE INSERT ON movie "
+                "WHEN new.name = 'test-conflict' "
+                "BEGIN SELECT RAISE(ABORT, 'conflict'); END"
+            ))
+            db.session.commit()
+
+        movies = [_get_movie_json("bulk-1"), _get_movie_json("conflict"), _get_movie_json("bulk-2")]
+        movies[0]["actors"] = ["test-actor-new"]
+        movies[1]["actors"] = ["test-actor-ghost"]
+        response = client.post(self.VALID_URL, json=movies)
+        body = json.loads(response.data)
+        assert [r["status"] for r in body["results"]] == [201, 409, 201]
+        assert body["results"][1]["@error"]["@message"] == "Database conflict"
+
+        response = client.get("/api/movies/test-bulk-1/")
+        assert json.loads(response.data)["data"]["actors"] == ["test-actor-new"]
+        response = client.get("/api/actors/")
+        actors = [actor["name"] for actor in json.loads(response.data)["actors"]]
+        assert "test-actor-ghost" not in actors
+
+    def test_movie_named_bulk(self, client):
+        response = client.post("/api/movies/", json={"name": "bulk"})
+        assert response.status_code == 201
+        url = response.headers["Location"]
+        assert url == "/api/movies/bulk/"
+        response = client.get(url)
+        assert response.status_code == 200
+        assert json.loads(response.data)["data"]["name"] == "bulk"
+        response = client.delete(url)
+        assert response.status_code == 204
+
+    def test_post_ndjson(self, client):
+        lines = [
+            json.dumps(_get_movie_json("bulk-1")),
+            "{not json",
+            "",
+            json.dumps(_get_movie_json("bulk-2")),
+        ]
+        response = client.post(
+            self.VALID_URL,
+            data="\n".join(lines),
+            content_type="application/x-ndjson"
+        )
+        assert response.status_code == 200
+        body = json.loads(response.data)
+        assert [r["index"] for r in body["results"]] == [0, 1, 2]
+        assert [r["status"] for r in body["results"]] == [201, 400, 201]
+
+    def test_post_invalid(self, client):
+        movie = json.dumps(_get_movie_json("bulk-1"))
+
+        # Movies before the syntax error are kept
+        response = client.post(
+            self.VALID_URL,
+            data="[" + movie + "] \n{}",
+            content_type="application/json"
+        )
+        assert response.status_code == 200
+        body = json.loads(response.data)
+        assert [r["status"] for r in body["results"]] == [201, 400]
+        assert body["results"][1]["@error"]["@messages"] == ["Invalid JSON: unexpected data after the array"]
+
+        for data in ("[" + movie + "]]", '[{"name": 5}]', "[" + movie + ", "):
+            response = client.post(self.VALID_URL, data=data, content_type="application/json")
+            assert response.status_code == 400
+            assert json.loads(response.data)["created"] == 0
+
+        response = client.post(self.VALID_URL, data=" [] \n", content_type="application/json")
+        assert response.status_code == 200
+        assert json.loads(response.data)["results"] == []
+
     def test_put(self, client):
         response = client.put(self.VALID_URL)
         assert response.status_code == 405
@@ -222,6 +530,74 @@ class TestMovieItem(object):
         response = client.get(self.INVALID_URL)
         assert response.status_code == 404
 
+    def test_url_template(self, client):
+        movie = SimpleNamespace(name="a {0} b/ä?")
+        review = SimpleNamespace(reviewer="x%y")
+        for script_root in ("", "/root"):
+            with client.application.test_request_context(
+                "/", environ_base={"SCRIPT_NAME": script_root}
+            ):
+                assert url_template("api.movieitem", "movie")(movie.name) == url_for(
+                    "api.movieitem", movie=movie
+                )
+                assert url_template("api.reviewitem", "movie", "review")(
+                    movie.name, review.reviewer
+                ) == url_for("api.reviewitem", movie=movie, review=review)
+
+        # Prebuilt controls share the schema but not the control itself
+        response = client.get(self.VALID_URL)
+        body = json.loads(response.data)
+        assert body["@controls"]["edit_movie"]["href"] == self.VALID_URL
+        with client.application.test_request_context("/"):
+            first = SuperkinodbBuilder()
+            first.add_control_edit_movie(movie)
+            second = SuperkinodbBuilder()
+            second.add_control_edit_movie(SimpleNamespace(name="other"))
+            assert first["@controls"]["edit_movie"]["href"] == "/api/movies/a {0} b/ä?/"
+            assert second["@controls"]["edit_movie"]["href"] == "/api/movies/other/"
+            assert first["@controls"]["edit_movie"]["schema"] is second["@controls"]["edit_movie"]["schema"]
+
+    def test_get_cached(self, client, monkeypatch):
+        calls = []
+        serialize = Movie.serialize
+        monkeypatch.setattr(
+            Movie,
+            "serialize",
+            lambda self, **kwargs: calls.append(self.name) or serialize(self, **kwargs)
+        )
+
+        first = client.get(self.VALID_URL)
+        second = client.get(self.VALID_URL)
+        assert first.data == second.data
+        assert len(calls) == 1
+
+        data = _get_movie_json()
+        data["name"] = "test-movie-1"
+        data["genre"] = "western"
+        response = client.put(self.VALID_URL, json=data)
+        assert response.status_code == 204
+
+        response = client.get(self.VALID_URL)
+        assert json.loads(response.data)["data"]["genre"] == "western"
+        assert len(calls) == 2
+
+    def test_get_conditional(self, client):
+        response = client.get(self.VALID_URL)
+        etag = response.headers["ETag"]
+
+        response = client.get(self.VALID_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        data = _get_movie_json()
+        data["name"] = "test-movie-1"
+        data["actors"] = ["test-actor-2"]
+        response = client.put(self.VALID_URL, json=data)
+        assert response.status_code == 204
+
+        response = client.get(self.VALID_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert json.loads(response.data)["data"]["actors"] == ["test-actor-2"]
+
     def test_post(self, client):
         response = client.post(self.VALID_URL)
         assert response.status_code == 405
@@ -248,6 +624,17 @@ class TestMovieItem(object):
         response = client.put(self.VALID_URL, json=data)
         assert response.status_code == 400
 
+    def test_put_rename(self, client):
+        # The reviews of the movie follow it to its new name
+        data = _get_movie_json("renamed")
+        response = client.put(self.VALID_URL, json=data)
+        assert response.status_code == 204
+        response = client.get("/api/movies/test-renamed/reviews/")
+        assert response.status_code == 200
+        assert len(json.loads(response.data)["reviews"]) == 3
+        response = client.get("/api/movies/test-renamed/")
+        assert json.loads(response.data)["data"]["reviews"]["count"] == 3
+
     def test_delete(self, client):
         response = client.delete(self.VALID_URL)
         assert response.status_code == 204
@@ -270,6 +657,65 @@ class TestReviewCollection(object):
         for review in body["reviews"]:
             _check_control_get(client, "self", review)
 
+    def test_get_streamed(self, client):
+        # Inserted last but sorts first
+        client.post(self.VALID_URL, json=_get_review_json("a-reviewer"))
+        body = json.loads(client.get(self.VALID_URL).data)
+        assert [r["data"]["reviewer"] for r in body["reviews"]] == [
+            "test-a-reviewer", "test-reviewer-1", "test-reviewer-2", "test-reviewer-3"
+        ]
+        response = client.get(self.VALID_URL + "?stream=mason")
+        assert json.loads(response.data) == body
+
+    def test_review_stats(self, client):
+        def stats():
+            response = client.get("/api/movies/test-movie-1/")
+            return json.loads(response.data)["data"]["reviews"]
+
+        assert stats() == {"count": 3, "score_mean": 5.0, "score_min": 5.0, "score_max": 5.0}
+
+        data = _get_review_json()
+        data["score"] = 8.0
+        response = client.post(self.VALID_URL, json=data)
+        assert response.status_code == 201
+        assert stats() == {"count": 4, "score_mean": 5.75, "score_min": 5.0, "score_max": 8.0}
+
+        data["score"] = 1.0
+        response = client.put(self.VALID_URL + data["reviewer"] + "/", json=data)
+        assert response.status_code == 204
+        assert stats() == {"count": 4, "score_mean": 4.0, "score_min": 1.0, "score_max": 5.0}
+
+        response = client.delete(self.VALID_URL + data["reviewer"] + "/")
+        assert response.status_code == 204
+        assert stats() == {"count": 3, "score_mean": 5.0, "score_min": 5.0, "score_max": 5.0}
+
+        with client.application.app_context():
+            db.session.execute(db.text("UPDATE movie SET review_count = 0, score_min = NULL"))
+            db.session.commit()
+        result = client.application.test_cli_runner().invoke(args=["rebuild-review-stats"])
+        assert result.exit_code == 0
+        with client.application.app_context():
+            movie = Movie.query.filter_by(name="test-movie-1").first()
+            assert movie.review_count == 3
+            assert movie.score_min == 5.0
+
+    def test_get_conditional(self, client):
+        response = client.get(self.VALID_URL)
+        etag = response.headers["ETag"]
+        assert response.headers["Last-Modified"]
+
+        response = client.get(self.VALID_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+
+        response = client.post(self.VALID_URL, json=_get_review_json())
+        assert response.status_code == 201
+
+        response = client.get(self.VALID_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert len(json.loads(response.data)["reviews"]) == 4
+
     def test_post(self, client):
         data = _get_review_json()
 
@@ -359,10 +805,100 @@ class TestReviewItem(object):
         response = client.delete(self.INVALID_URL)
         assert response.status_code == 404
 
+class TestSearchCollection(object):
+    VALID_URL = "/api/search/"
+    VALID_METHODS = "GET"
+
+    def test_get(self, client):
+        response = client.get(self.VALID_URL + "?q=horror&limit=3")
+        assert response.status_code == 200
+        body = json.loads(response.data)
+        _check_namespace(client, body)
+        assert len(body["results"]) == 3
+        for result in body["results"]:
+            assert result["data"]["type"] == "movie"
+            _check_control_get(client, "self", result)
+        response = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(response.data)
+        assert len(body["results"]) == 1
+        assert "next" not in body["@controls"]
+        _check_control_get(client, "prev", body)
+
+        response = client.get(self.VALID_URL)
+        assert response.status_code == 400
+        response = client.get(self.VALID_URL + "?q=horror&type=actor")
+        assert response.status_code == 400
+        response = client.get(self.VALID_URL + '?q="unbalanced AND (')
+        assert response.status_code == 200
+
+    def test_get_synced(self, client):
+        data = _get_review_json()
+        data["review_text"] = "An unforgettable masterpiece"
+        response = client.post("/api/movies/test-movie-2/reviews/", json=data)
+        assert response.status_code == 201
+
+        response = client.get(self.VALID_URL + "?q=masterpiece")
+        results = json.loads(response.data)["results"]
+        assert [r["data"]["reviewer"] for r in results] == [data["reviewer"]]
+        assert "[masterpiece]" in results[0]["data"]["snippet"]
+        _check_control_get(client, "self", results[0])
+
+        movie = _get_movie_json()
+        movie["name"] = "test-movie-2"
+        movie["genre"] = "documentary"
+        response = client.put("/api/movies/test-movie-2/", json=movie)
+        assert response.status_code == 204
+        response = client.get(self.VALID_URL + "?q=documentary&type=movie")
+        results = json.loads(response.data)["results"]
+        assert [r["data"]["name"] for r in results] == ["test-movie-2"]
+
+        response = client.delete("/api/movies/test-movie-2/")
+        assert response.status_code == 204
+        response = client.get(self.VALID_URL + "?q=masterpiece")
+        assert json.loads(response.data)["results"] == []
+        response = client.get(self.VALID_URL + "?q=documentary")
+        assert json.loads(response.data)["results"] == []
+
+    def test_post(self, client):
+        response = client.post(self.VALID_URL)
+        assert response.status_code == 405
+        assert response.headers["Allow"] == self.VALID_METHODS
+
 class TestActorCollection(object):
     VALID_URL = "/api/actors/"
     VALID_METHODS = "GET"
 
+    def test_get_query_count(self, client):
+        app = client.application
+        statements = []
+
+        def count_queries(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", count_queries)
+
+        response = client.get(self.VALID_URL)
+        assert response.status_code == 200
+        baseline = len(statements)
+
+        with app.app_context():
+            for i in range(20):
+                movie = Movie(
+                    name="test-movie-extra-{}".format(i),
+                    release=date.today(),
+                    genre="horror"
+                )
+                movie.actors.append(Actor(name="test-actor-extra-{}".format(i)))
+                db.session.add(movie)
+            db.session.commit()
+
+        del statements[:]
+        response = client.get(self.VALID_URL)
+        assert response.status_code == 200
+        assert len(json.loads(response.data)["actors"]) == 24
+        assert len(statements) == baseline
+
     def test_get(self, client):
         response = client.post(self.VALID_URL)
         assert response.status_code == 405
@@ -415,3 +951,114 @@ class TestWriterCollection(object):
         response = client.delete(self.VALID_URL)
         assert response.status_code == 405
         assert response.headers["Allow"] == self.VALID_METHODS
+
+class TestInstrumentation(object):
+
+    def test_timings(self, make_app, caplog):
+        app = make_app(INSTRUMENTATION=True, SLOW_QUERY_THRESHOLD=0)
+        client = app.test_client()
+        caplog.clear()
+
+        with caplog.at_level("INFO", logger="superkinodb"):
+            resp = client.post("/api/movies/", json=_get_movie_json())
+        assert resp.status_code == 201
+        timing = resp.headers["Server-Timing"]
+        for name in ("sql", "validation", "json", "total"):
+            assert name + ";dur=" in timing
+
+        lines = [json.loads(r.getMessage()) for r in caplog.records if r.name == "superkinodb.requests"]
+        assert len(lines) == 1
+        assert lines[0]["endpoint"] == "api.moviecollection"
+        assert lines[0]["status"] == 201
+        assert lines[0]["queries"] > 0
+        assert lines[0]["validation_ms"] > 0
+        slow = [json.loads(r.getMessage()) for r in caplog.records if r.name == "superkinodb.slow_queries"]
+        assert len(slow) == lines[0]["queries"]
+        assert all(q["endpoint"] == "api.moviecollection" and q["statement"] for q in slow)
+
+class TestMetrics(object):
+
+    def test_get(self, make_app, tmp_path):
+        metrics_dir = str(tmp_path)
+        app = make_app(METRICS=True, METRICS_DIR=metrics_dir)
+        client = app.test_client()
+
+        assert client.get("/api/movies/").status_code == 200
+        assert client.get("/api/movies/").status_code == 200
+        assert client.get("/api/movies/test-movie-1/").status_code == 200
+
+        # Another worker process sharing the directory
+        other = Registry()
+        other.inc("superkinodb_requests_total", {"route": "/api/movies/", "method": "GET", "status": "200"}, 5)
+        with open(os.path.join(metrics_dir, "metrics-1.json"), "w") as f:
+            json.dump(other.snapshot(), f)
+
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.data.decode("utf-8")
+        assert 'superkinodb_requests_total{method="GET",route="/api/movies/",status="200"} 7' in text
+        assert 'superkinodb_request_duration_seconds_count{method="GET",route="/api/movies/<movie:movie>/"} 1' in text
+        assert 'superkinodb_request_duration_seconds_bucket{method="GET",route="/api/movies/",le="+Inf"} 2' in text
+        assert 'superkinodb_response_size_bytes_count{method="GET",route="/api/movies/"} 2' in text
+        assert 'superkinodb_cache_requests_total{result="hit"} 1' in text
+        assert 'superkinodb_cache_requests_total{result="miss"} 2' in text
+        assert 'superkinodb_db_queries_total{route="/api/movies/"}' in text
+        assert "# TYPE superkinodb_sqlite_lock_failures_total counter" in text
+
+    def test_lock_wait(self, make_app):
+        app = make_app(METRICS=True)
+        client = app.test_client()
+
+        # Another process holds the write lock for a while
+        path = make_url(app.config["SQLALCHEMY_DATABASE_URI"]).database
+        other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        other.execute("BEGIN IMMEDIATE")
+        timer = threading.Timer(0.3, other.rollback)
+        timer.start()
+        try:
+            resp = client.post("/api/movies/", json=_get_movie_json())
+        finally:
+            timer.join()
+            other.close()
+        assert resp.status_code == 201
+
+        text = client.get("/metrics").data.decode("utf-8")
+        prefix = 'superkinodb_db_write_seconds_sum{route="/api/movies/"} '
+        waited = [float(line[len(prefix):]) for line in text.splitlines() if line.startswith(prefix)]
+        assert waited and waited[0] >= 0.3
+        assert "superkinodb_sqlite_lock_failures_total{" not in text
+
+class TestReplicas(object):
+
+    def test_routing(self, make_app, tmp_path):
+        app = make_app(
+            REPLICA_DATABASES=[str(tmp_path / "replica.db")],
+            REPLICA_MAX_LAG=60
+        )
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["replicate"])
+        assert result.exit_code == 0
+
+        writer = app.test_client()
+        reader = app.test_client()
+        resp = writer.post("/api/movies/", json=_get_movie_json())
+        assert resp.status_code == 201
+
+        # Other clients read the replica until it's copied again, the writer
+        # reads its own write from the primary
+        assert reader.get("/api/movies/test-movie/").status_code == 404
+        assert reader.get("/api/movies/test-movie-1/").status_code == 200
+        assert writer.get("/api/movies/test-movie/").status_code == 200
+
+        result = runner.invoke(args=["replicate"])
+        assert result.exit_code == 0
+        assert reader.get("/api/movies/test-movie/").status_code == 200
+
+        assert reader.delete("/api/movies/test-movie-1/").status_code == 204
+        assert reader.get("/api/movies/test-movie-1/").status_code == 404
+        assert writer.get("/api/movies/test-movie-1/").status_code == 200
+
+        # A replica that is too old isn't used
+        app.config["REPLICA_MAX_LAG"] = 0
+        assert writer.get("/api/movies/test-movie-1/").status_code == 404